@@ -0,0 +1,144 @@
+import argparse
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# In-memory stand-in for the Blogger v3 posts API, for trying bulk uploads
+# without touching a real blog:
+#   python blogger_mock.py --port 8765 --rate-limit 5
+#   python upload_post.py bulk ../../markdown none 1 --api-endpoint http://127.0.0.1:8765/
+
+POST_RE = re.compile(r"^/v3/blogs/(?P<blog>[^/]+)/posts(?:/(?P<post>[^/]+))?(?P<publish>/publish)?$")
+
+
+class MockBlogger:
+    """Posts, request counts and received bytes of the mock server.
+
+    With `rate_limit` set, requests beyond that many per second are answered
+    with 429 like the real API's quota errors."""
+
+    def __init__(self, rate_limit=None):
+        self.rate_limit = rate_limit
+        self.posts = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.window = (0, 0)  # (second, requests in it)
+        self.stats = {"requests": 0, "rate_limited": 0, "bytes_received": 0, "by_method": {}}
+
+    def throttled(self):
+        with self.lock:
+            second, count = self.window
+            now = int(time.time())
+            count = count + 1 if now == second else 1
+            self.window = (now, count)
+            return self.rate_limit is not None and count > self.rate_limit
+
+    def record(self, method, nbytes, rate_limited=False):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes_received"] += nbytes
+            self.stats["rate_limited"] += rate_limited
+            self.stats["by_method"][method] = self.stats["by_method"].get(method, 0) + 1
+
+    def handle(self, method, path, query, body):
+        # (status, response JSON) of a posts API call
+        m = POST_RE.match(path)
+        if m is None:
+            return 404, error(404, "notFound", f"No route for {method} {path}")
+        post_id = m.group("post")
+        with self.lock:
+            if method == "POST" and post_id is None:
+                post_id = str(next(self.ids))
+                draft = query.get("isDraft", ["false"])[0] == "true"
+                self.posts[post_id] = {
+                    **body, "id": post_id, "blog": {"id": m.group("blog")},
+                    "status": "DRAFT" if draft else "LIVE",
+                }
+                return 200, self.posts[post_id]
+            if post_id not in self.posts:
+                return 404, error(404, "notFound", f"Post {post_id} not found")
+            post = self.posts[post_id]
+            if method == "POST" and m.group("publish"):
+                post["status"] = "LIVE"
+                if "publishDate" in query:
+                    post["published"] = query["publishDate"][0]
+            elif method == "PATCH":
+                post.update({k: v for k, v in body.items() if k != "id"})
+            elif method != "GET":
+                return 405, error(405, "methodNotAllowed", f"{method} not supported")
+            return 200, post
+
+
+def error(code, reason, message):
+    return {"error": {"code": code, "message": message, "errors": [{"reason": reason, "message": message}]}}
+
+
+def make_handler(blogger):
+    class Handler(BaseHTTPRequestHandler):
+        def respond(self, method):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            url = urlsplit(self.path)
+            if url.path == "/mock/stats":
+                status, payload = 200, blogger.stats
+            elif blogger.throttled():
+                blogger.record(method, len(raw), rate_limited=True)
+                status, payload = 429, error(429, "rateLimitExceeded", "Rate limit exceeded")
+            else:
+                blogger.record(method, len(raw))
+                body = json.loads(raw) if raw else {}
+                status, payload = blogger.handle(method, url.path, parse_qs(url.query), body)
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=UTF-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.respond("GET")
+
+        def do_POST(self):
+            self.respond("POST")
+
+        def do_PATCH(self):
+            self.respond("PATCH")
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(port=8765, rate_limit=None):
+    # Returns the running server; its MockBlogger is server.blogger
+    blogger = MockBlogger(rate_limit)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(blogger))
+    server.blogger = blogger
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the Blogger v3 posts API.')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--rate-limit', type=int, default=None,
+                        help='Answer requests beyond this many per second with 429')
+    args = parser.parse_args()
+
+    server = serve(args.port, args.rate_limit)
+    print(f"Mock Blogger API on http://127.0.0.1:{args.port}/ (stats at /mock/stats, Ctrl-C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(json.dumps(server.blogger.stats, indent=2))
+
+
+if __name__ == '__main__':
+    main()
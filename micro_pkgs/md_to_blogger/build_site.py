@@ -0,0 +1,271 @@
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import md_to_html_v2 as md_to_html
+from image_cache import ImageCache
+
+MANIFEST_NAME = ".md_to_blogger_manifest.json"
+
+# Per-process Markdown instance, created once by init_worker()
+_MD = None
+
+
+def converter_hash(resizer_options=None, cache_dir=None):
+    # Changes to the converter (template, CSS, extensions, image cache) or to
+    # the image options (shrinking, DPI factor, format, cache use) rebuild
+    # every post
+    h = hashlib.sha256()
+    for module in (md_to_html, sys.modules[ImageCache.__module__], sys.modules[__name__]):
+        with open(module.__file__, "rb") as f:
+            h.update(f.read())
+    options = {"resizer": resizer_options, "cache": cache_dir is not None}
+    h.update(json.dumps(options, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class Manifest:
+    """Content hashes of each post's source and dependencies from the last
+    build, stored as JSON in the output directory.
+
+    File hashes are remembered with the file's mtime and size so unchanged
+    files are not read again to be hashed."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            data = {}
+        self.converter = data.get("converter")
+        self.posts = data.get("posts", {})
+        self.files = data.get("files", {})
+
+    def file_hash(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        known = self.files.get(path)
+        if known and known["mtime_ns"] == st.st_mtime_ns and known["size"] == st.st_size:
+            return known["sha256"]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        self.files[path] = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "sha256": h.hexdigest()}
+        return h.hexdigest()
+
+    def post_hash(self, infile):
+        # Dependencies are named relative to the post so the hash survives
+        # moving the checkout
+        base = os.path.dirname(os.path.abspath(infile))
+        h = hashlib.sha256()
+        for dep in md_to_html.post_dependencies(infile):
+            h.update(os.path.relpath(dep, base).replace(os.sep, "/").encode())
+            h.update(str(self.file_hash(dep)).encode())
+        return h.hexdigest()
+
+    def save(self, converter):
+        data = {"converter": converter, "posts": self.posts, "files": self.files}
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+def init_worker(cache_dir=None, resizer_options=None):
+    # One configured Markdown instance per worker, reset between documents
+    global _MD
+    image_cache = ImageCache(cache_dir) if cache_dir else None
+    image_resizer = md_to_html.ImageResizer(**resizer_options) if resizer_options is not None else None
+    _MD = md_to_html.create_markdown(image_cache=image_cache, image_resizer=image_resizer)
+
+
+def build_post(infile, outfile):
+    start = time.perf_counter()
+    html = md_to_html.convert(_MD, infile)
+    os.makedirs(os.path.dirname(outfile) or ".", exist_ok=True)
+    with open(outfile, "w") as f:
+        f.write(html)
+    return time.perf_counter() - start
+
+
+def find_posts(src_dir, exclude=("README.md",)):
+    posts = []
+    for root, dirs, files in os.walk(src_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            if name.endswith(".md") and not any(fnmatch.fnmatch(name, pat) for pat in exclude):
+                posts.append(os.path.join(root, name))
+    return posts
+
+
+def output_path(src_dir, out_dir, infile):
+    rel = os.path.relpath(infile, src_dir)
+    return os.path.join(out_dir, os.path.splitext(rel)[0] + ".html")
+
+
+def build_site(src_dir, out_dir, workers=None, cache_dir=None, resizer_options=None,
+               force=False, exclude=("README.md",)):
+    """Convert every post under src_dir to out_dir (same relative layout,
+    .html suffix) across a process pool, skipping posts whose source,
+    images, includes, converter and image options are unchanged since the
+    last build.
+
+    Returns the list of rebuilt source files."""
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = Manifest(os.path.join(out_dir, MANIFEST_NAME))
+    converter = converter_hash(resizer_options, cache_dir)
+    if manifest.converter != converter:
+        force = True
+
+    jobs = []
+    hashes = {}
+    posts = find_posts(src_dir, exclude)
+    for infile in posts:
+        rel = os.path.relpath(infile, src_dir)
+        outfile = output_path(src_dir, out_dir, infile)
+        hashes[rel] = manifest.post_hash(infile)
+        if force or manifest.posts.get(rel) != hashes[rel] or not os.path.exists(outfile):
+            jobs.append((rel, infile, outfile))
+
+    print(f"{len(jobs)} of {len(posts)} posts to build")
+    start = time.perf_counter()
+    infiles = [infile for _, infile, _ in jobs]
+    outfiles = [outfile for _, _, outfile in jobs]
+    pool = None
+    if workers == 1:
+        init_worker(cache_dir, resizer_options)
+        results = map(build_post, infiles, outfiles)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                   initargs=(cache_dir, resizer_options))
+        results = pool.map(build_post, infiles, outfiles)
+    try:
+        for (rel, _, _), elapsed in zip(jobs, results):
+            manifest.posts[rel] = hashes[rel]
+            print(f"built {rel} ({elapsed:.2f} s)")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        manifest.save(converter)
+    print(f"Build finished in {time.perf_counter() - start:.2f} s")
+    return [rel for rel, _, _ in jobs]
+
+
+def file_stat(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def watch(src_dir, out_dir, interval=0.5, cache_dir=None, resizer_options=None,
+          exclude=("README.md",)):
+    """Keep the converter warm and rebuild posts when they or their
+    dependencies (local images, {{ include }} files) change.
+
+    Files are polled every `interval` seconds. Only the posts depending on a
+    changed file are re-rendered (and only if their content hash changed),
+    and the rebuild latency is reported. Stop with Ctrl-C."""
+    # Bring the outputs up to date; this also creates the warm Markdown instance
+    build_site(src_dir, out_dir, workers=1, cache_dir=cache_dir,
+               resizer_options=resizer_options, exclude=exclude)
+    manifest = Manifest(os.path.join(out_dir, MANIFEST_NAME))
+    converter = converter_hash(resizer_options, cache_dir)
+    stats = {}  # Watched file -> (mtime_ns, size)
+    deps = {}  # Post -> its dependencies
+
+    def track(post):
+        deps[post] = md_to_html.post_dependencies(post)
+        for dep in deps[post]:
+            stats[dep] = file_stat(dep)
+
+    for post in find_posts(src_dir, exclude):
+        track(post)
+    print(f"Watching {len(deps)} posts and {len(stats)} files (Ctrl-C to stop)")
+
+    try:
+        while True:
+            time.sleep(interval)
+            changed = {path for path, old in stats.items() if file_stat(path) != old}
+            for path in changed:
+                stats[path] = file_stat(path)
+            posts = find_posts(src_dir, exclude)
+            affected = [p for p in posts if p not in deps or any(d in changed for d in deps[p])]
+            for post in set(deps) - set(posts):
+                del deps[post]
+                print(f"stopped watching {os.path.relpath(post, src_dir)}")
+            if not affected:
+                continue
+
+            start = time.perf_counter()
+            rebuilt = 0
+            for post in affected:
+                rel = os.path.relpath(post, src_dir)
+                track(post)
+                post_hash = manifest.post_hash(post)
+                if manifest.posts.get(rel) == post_hash:
+                    continue
+                try:
+                    elapsed = build_post(post, output_path(src_dir, out_dir, post))
+                except Exception as e:
+                    print(f"error building {rel}: {e}")
+                    continue
+                manifest.posts[rel] = post_hash
+                rebuilt += 1
+                print(f"rebuilt {rel} in {elapsed * 1000:.0f} ms")
+            if rebuilt:
+                manifest.save(converter)
+                print(f"Rebuild latency {(time.perf_counter() - start) * 1000:.0f} ms "
+                      f"({rebuilt} of {len(deps)} posts)")
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a directory of Markdown posts to Blogger HTML.')
+    parser.add_argument('src_dir', help='Directory with Markdown posts')
+    parser.add_argument('out_dir', help='Output directory for HTML files')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Worker processes (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true', help='Rebuild all posts')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and rebuild posts when they or their images/includes change')
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help='Polling interval in seconds for --watch')
+    parser.add_argument('--exclude', nargs='*', default=['README.md'],
+                        help='File name patterns to skip')
+    parser.add_argument('--cache-dir', help='Directory for the persistent image cache')
+    parser.add_argument('--shrink-images', action='store_true',
+                        help='Resize images to their display width and recompress (needs Pillow)')
+    parser.add_argument('--dpi-factor', type=float, default=2.0,
+                        help='Pixels per displayed pixel kept when shrinking images')
+    parser.add_argument('--image-format', default='webp', choices=['webp', 'png', 'jpeg', 'same'],
+                        help='Format of shrunk images')
+    args = parser.parse_args()
+
+    resizer_options = None
+    if args.shrink_images:
+        resizer_options = {
+            "dpi_factor": args.dpi_factor,
+            "image_format": None if args.image_format == 'same' else args.image_format,
+        }
+    if args.watch:
+        watch(args.src_dir, args.out_dir, interval=args.interval, cache_dir=args.cache_dir,
+              resizer_options=resizer_options, exclude=args.exclude)
+    else:
+        build_site(args.src_dir, args.out_dir, workers=args.workers, cache_dir=args.cache_dir,
+                   resizer_options=resizer_options, force=args.force, exclude=args.exclude)
+
+
+if __name__ == '__main__':
+    main()
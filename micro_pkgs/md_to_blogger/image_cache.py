@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class ImageCache:
+    """Persistent cache of base64 data URLs for embedded images.
+
+    Entries are keyed by what identifies the source image (a local file path
+    or a remote URL, plus an optional variant such as a resize setting) and
+    carry validators: `mtime_ns`/`size` for local files and `etag`/
+    `last_modified` for remote images. A lookup only hits when the
+    validators still match, so unchanged images are never re-read or
+    re-encoded.
+
+    The encoded data URLs are stored content-addressed under `blobs/` (named
+    by their sha256), so identical images share one file. The total blob
+    size is bounded by `max_bytes` with least-recently-used eviction.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(directory, "index.json")
+        self.blob_dir = os.path.join(directory, "blobs")
+        self.lock = threading.Lock()
+        os.makedirs(self.blob_dir, exist_ok=True)
+        try:
+            with open(self.index_file, "r") as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+    @staticmethod
+    def local_key(path, variant=""):
+        return f"file:{os.path.abspath(path)}|{variant}"
+
+    @staticmethod
+    def remote_key(url, variant=""):
+        return f"url:{url}|{variant}"
+
+    @staticmethod
+    def local_validators(path):
+        st = os.stat(path)
+        return {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+    def entry(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def request_headers(self, key):
+        # Conditional request headers for a cached remote image
+        entry = self.entry(key) or {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def get(self, key, **validators):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or any(entry.get(k) != v for k, v in validators.items()):
+                return None
+            try:
+                with open(self._blob_path(entry["blob"]), "r") as f:
+                    data_url = f.read()
+            except FileNotFoundError:
+                del self.entries[key]
+                return None
+            entry["used"] = time.time()
+            return data_url
+
+    def put(self, key, data_url, **validators):
+        blob = hashlib.sha256(data_url.encode()).hexdigest()
+        with self.lock:
+            path = self._blob_path(blob)
+            if not os.path.exists(path):
+                tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp, "w") as f:
+                    f.write(data_url)
+                os.replace(tmp, path)
+            self.entries[key] = {
+                "blob": blob,
+                "bytes": len(data_url),
+                "used": time.time(),
+                **validators,
+            }
+            self._evict()
+
+    def save(self):
+        # Merge with entries saved by other processes sharing the directory
+        with self.lock:
+            try:
+                with open(self.index_file, "r") as f:
+                    on_disk = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                on_disk = {}
+            for key, entry in on_disk.items():
+                if key not in self.entries or self.entries[key]["used"] < entry["used"]:
+                    if os.path.exists(self._blob_path(entry["blob"])):
+                        self.entries[key] = entry
+            self._evict()
+            tmp = f"{self.index_file}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.index_file)
+
+    def _blob_path(self, blob):
+        return os.path.join(self.blob_dir, f"{blob}.txt")
+
+    def _evict(self):
+        # Drop least recently used entries until the distinct blobs fit
+        blobs = {e["blob"]: e["bytes"] for e in self.entries.values()}
+        total = sum(blobs.values())
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["used"]):
+            if total <= self.max_bytes:
+                break
+            blob = self.entries.pop(key)["blob"]
+            if all(e["blob"] != blob for e in self.entries.values()):
+                total -= blobs[blob]
+                try:
+                    os.remove(self._blob_path(blob))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# CLI invocations whose start-up cost is tracked, {post} and {out} are
+# replaced by a small post without images or code and an output file
+COMMANDS = {
+    "md_to_html_v2 --help": ["md_to_html_v2.py", "--help"],
+    "md_to_html_v2 plain post": ["md_to_html_v2.py", "{post}", "{out}"],
+    "upload_post --help": ["upload_post.py", "--help"],
+}
+PLAIN_POST = """# A plain post
+
+Some *text* with a [link](#References) and a footnote[^1].
+
+#### References
+
+1. A reference.
+
+[^1]: A footnote.
+"""
+
+
+def parse_importtime(stderr):
+    # Cumulative microseconds of each top-level import from `python -X importtime`
+    top_level = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):  # Nested imports are indented further
+            top_level[name.strip()] = top_level.get(name.strip(), 0) + int(cumulative)
+    return top_level
+
+
+def measure(args, repeats):
+    # Median wall time of the command and the import profile of one run
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], cwd=HERE, capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    run = subprocess.run([sys.executable, "-X", "importtime", *args], cwd=HERE,
+                         capture_output=True, text=True, check=True)
+    imports = parse_importtime(run.stderr)
+    return {
+        "wall_ms": statistics.median(times) * 1000,
+        "import_ms": sum(imports.values()) / 1000,
+        "top_imports_ms": {
+            name: us / 1000
+            for name, us in sorted(imports.items(), key=lambda kv: -kv[1])[:10]
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Track `python -X importtime` start-up cost of the CLIs.')
+    parser.add_argument('--repeats', type=int, default=5, help='Runs per command for the wall time')
+    parser.add_argument('--save-baseline', help='Write results to a JSON file')
+    parser.add_argument('--baseline', help='Compare against a baseline JSON')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed relative slowdown vs. the baseline')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        post = os.path.join(tmp, "plain.md")
+        with open(post, "w") as f:
+            f.write(PLAIN_POST)
+        out = os.path.join(tmp, "plain.html")
+        results = {
+            name: measure([a.format(post=post, out=out) for a in cmd], args.repeats)
+            for name, cmd in COMMANDS.items()
+        }
+    for name, result in results.items():
+        print(f"{name}: {result['wall_ms']:.1f} ms wall, {result['import_ms']:.1f} ms imports")
+        for module, ms in result["top_imports_ms"].items():
+            print(f"    {module:<30} {ms:8.1f} ms")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = 0
+        for name, result in results.items():
+            if name in baseline:
+                ratio = result["import_ms"] / max(baseline[name]["import_ms"], 1e-3)
+                if ratio > 1 + args.tolerance:
+                    regressions += 1
+                    print(f"REGRESSION {name}: imports {ratio:.2f}x baseline")
+        if regressions:
+            sys.exit(1)
+        print("No import-time regressions.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,39 @@
-import requests
 import markdown
 from markdown.extensions import Extension
 from markdown.preprocessors import Preprocessor
 from markdown.postprocessors import Postprocessor
 from markdown.treeprocessors import Treeprocessor
 
-from markdown.inlinepatterns import InlineProcessor
 import xml.etree.ElementTree as etree
-from xml.etree.ElementTree import Element
-from xml.etree.ElementTree import Element, SubElement, tostring
-from xml.dom.minidom import parseString
 
+import argparse
 import html
+import importlib.util
 import re
 import sys
 import os
 import base64
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name, TextLexer
-from pygments.formatters import HtmlFormatter
-from pygments.util import ClassNotFound
-from bs4 import BeautifulSoup
+import functools
+import io
+from concurrent.futures import ThreadPoolExecutor
 
-import emoji
+from image_cache import ImageCache
+
+# requests, bs4, pygments, emoji and PIL are imported where they are used so
+# that the CLI starts fast and a post only pays for the features it needs.
 
 class LinkPreviewPostprocessor(Postprocessor):
     def run(self, text):
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(text, 'html.parser')
+        self.add_previews(soup)
+        return str(soup)
 
+    @classmethod
+    def add_previews(cls, soup):
         # Extract references and footnotes text
-        references_text = self.extract_section_text(soup, 'References')
-        footnotes_text = self.extract_footnotes_text(soup)
+        references_text = cls.extract_section_text(soup, 'References')
+        footnotes_text = cls.extract_footnotes_text(soup)
 
         # Add 'data-preview' attribute to internal links to references and footnotes
         for a in soup.find_all('a', href=True):
@@ -42,8 +45,6 @@ class LinkPreviewPostprocessor(Postprocessor):
 
             a['class'] = a.get('class', []) + ['preview-link']
 
-        return str(soup)
-
     @staticmethod
     def extract_section_text(soup, section_id):
         section = soup.find('h4', string=lambda text: text and text.lower() == section_id.lower())
@@ -108,10 +109,15 @@ class CustomCSSPostprocessor(Postprocessor):
 
 class TableClassPostprocessor(Postprocessor):
     def run(self, text):
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(text, 'html.parser')
+        self.add_table_class(soup)
+        return str(soup)
+
+    @staticmethod
+    def add_table_class(soup):
         for table in soup.find_all('table'):
             table['class'] = table.get('class', []) + ['custom-table']
-        return str(soup)
     
 class CustomCSSExtension(Extension):
     def extendMarkdown(self, md):
@@ -122,15 +128,51 @@ class TableClassExtension(Extension):
     def extendMarkdown(self, md):
         md.postprocessors.register(TableClassPostprocessor(md), 'table_class', 5)
 
+# Pygments lexers and the formatter are reused for every block in the
+# process, and highlighted blocks are memoized so unchanged code is not
+# re-highlighted when posts are rebuilt by a long-lived process.
+HTML_ESCAPE_TABLE = str.maketrans(
+    {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}
+)
+
+@functools.lru_cache(maxsize=None)
+def get_formatter():
+    from pygments.formatters import HtmlFormatter
+    return HtmlFormatter(nowrap=True)  # Ensures no extra <pre> tags
+
+@functools.lru_cache(maxsize=None)
+def get_lexer(lang):
+    from pygments.lexers import get_lexer_by_name, TextLexer
+    from pygments.util import ClassNotFound
+    try:
+        return get_lexer_by_name(lang, stripall=True)
+    except ClassNotFound:
+        return TextLexer()
+
+@functools.lru_cache(maxsize=4096)
+def highlight_code(lang, code):
+    from pygments import highlight
+    return highlight(code, get_lexer(lang), get_formatter())
+
+def escape_code(code):
+    # Same output as highlighting with TextLexer, without running Pygments
+    code = code.replace('\r\n', '\n').replace('\r', '\n').strip('\n')
+    return code.translate(HTML_ESCAPE_TABLE)
+
+def render_code_block(lang, code):
+    highlighted = highlight_code(lang, code)
+    return f'<pre class="language-{lang}"><code>{highlighted}</code></pre>'
+
+def render_inline_code(code):
+    highlighted_code = escape_code(code.replace("\n", " "))
+    highlighted_code = highlighted_code.rstrip()  # Remove trailing spaces
+    return '<span class="inline-code-highlight">%s</span>' % highlighted_code
+
 # Updated CodeBlockPreprocessor
 class CodeBlockPreprocessor(Preprocessor):
     CODE_BLOCK_RE = re.compile(r'^```(\w+)?\s*$')
     END_CODE_BLOCK_RE = re.compile(r'^```\s*$')
 
-    def __init__(self, md, **options):
-        super().__init__(md)
-        self.formatter = HtmlFormatter(nowrap=False, **options)
-
     def run(self, lines):
         new_lines = []
         code_block = []
@@ -162,29 +204,15 @@ class CodeBlockPreprocessor(Preprocessor):
         return new_lines
 
     def _highlight_code(self, lang, code):
-        try:
-            lexer = get_lexer_by_name(lang, stripall=True)
-        except ClassNotFound:
-            lexer = TextLexer()
-        self.formatter = HtmlFormatter(nowrap=True)  # Ensures no extra <pre> tags
-        highlighted = highlight(code, lexer, self.formatter)
-        return f'<pre class="language-{lang}"><code>{highlighted}</code></pre>'
+        return render_code_block(lang, code)
 
 # Updated InlineCodePreprocessor
 class InlineCodePreprocessor(Preprocessor):
     INLINE_CODE_RE = re.compile(r"`(?P<code>.+?)`", re.DOTALL)
 
-    def __init__(self, md):
-        super().__init__(md)
-        self.formatter = HtmlFormatter(nowrap=True)
-
     def run(self, lines):
         def repl(m):
-            code = m.group("code").replace("\n", " ")
-            lexer = TextLexer()
-            highlighted_code = highlight(code, lexer, self.formatter)
-            highlighted_code = highlighted_code.rstrip()  # Remove trailing spaces
-            return '<span class="inline-code-highlight">%s</span>' % highlighted_code
+            return render_inline_code(m.group("code"))
 
         text = "\n".join(lines)
         text = self.INLINE_CODE_RE.sub(repl, text)
@@ -195,79 +223,251 @@ class CodeBlockExtension(Extension):
         md.preprocessors.register(CodeBlockPreprocessor(md), "code_block", 175)
         md.preprocessors.register(InlineCodePreprocessor(md), "inline_code", 150)
 
+class ImageResizer:
+    """Downscale and recompress images before they are base64 embedded.
+
+    Images wider than display_width * dpi_factor pixels are resized to that
+    width and re-encoded as WebP, optimized PNG or JPEG (image_format=None
+    keeps the source format). Narrower images, formats Pillow cannot resize
+    (svg, gif) and re-encodes that come out larger are left untouched.
+    """
+    PASSTHROUGH_EXTS = {"svg", "gif"}
+
+    def __init__(self, display_width=500, dpi_factor=2.0, image_format="webp", quality=85):
+        self.max_width = int(display_width * dpi_factor)
+        self.image_format = image_format
+        self.quality = quality
+        self.available = importlib.util.find_spec("PIL") is not None
+        if not self.available:
+            print("Pillow is not installed, images are embedded without resizing.")
+
+    @property
+    def variant(self):
+        # Part of the image cache key so each setting is cached separately
+        return f"w{self.max_width}-{self.image_format or 'same'}-q{self.quality}"
+
+    @staticmethod
+    def convert_mode(img, image_format):
+        # Modes the encoders can't write: 16/32-bit and float grayscale are
+        # scaled to 8-bit L, CMYK/YCbCr/... become RGB, and JPEG gets alpha
+        # composited onto white
+        from PIL import Image
+        if img.mode.startswith("I;16") or img.mode == "I":
+            img = img.convert("I").point(lambda v: v * (1 / 256)).convert("L")
+        elif img.mode == "F":
+            # [0, 1] floats are scaled up, other out-of-range values stretched
+            # between the extrema, before the clipping conversion to L
+            low, high = img.getextrema()
+            if low >= 0 and high <= 1:
+                img = img.point(lambda v: v * 255)
+            elif (low < 0 or high > 255) and high > low:
+                scale = 255 / (high - low)
+                img = img.point(lambda v: (v - low) * scale)
+            img = img.convert("L")
+        if image_format == "jpeg":
+            if img.mode in ("RGBA", "LA", "P", "PA"):
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel("A"))
+                img = background
+            elif img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+        elif img.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        return img
+
+    def __call__(self, image_data, image_ext):
+        if not self.available or image_ext.lower() in self.PASSTHROUGH_EXTS:
+            return image_data, image_ext
+        from PIL import Image
+        try:
+            img = Image.open(io.BytesIO(image_data))
+            img.load()
+        except OSError:
+            return image_data, image_ext
+        if img.width <= self.max_width:
+            return image_data, image_ext
+
+        height = max(1, round(img.height * self.max_width / img.width))
+        img = img.resize((self.max_width, height), Image.LANCZOS)
+
+        image_format = self.image_format or ("jpeg" if image_ext.lower() in ("jpg", "jpeg") else "png")
+        img = self.convert_mode(img, image_format)
+        out = io.BytesIO()
+        try:
+            if image_format == "webp":
+                img.save(out, format="WEBP", quality=self.quality, method=4)
+            elif image_format == "jpeg":
+                img.save(out, format="JPEG", quality=self.quality, optimize=True, progressive=True)
+            else:
+                img.save(out, format="PNG", optimize=True)
+        except (OSError, ValueError):
+            return image_data, image_ext
+
+        if out.tell() >= len(image_data):
+            return image_data, image_ext
+        return out.getvalue(), image_format
+
 class ImagePreprocessor(Preprocessor):
     IMAGE_RE = re.compile(r"!\[(.*?)\]\((.*?)\)")
+    REMOTE_PREFIXES = ("http://", "https://", "www")
 
-    def __init__(self, md, markdown_file_dir):
+    def __init__(self, md, markdown_file_dir, max_workers=8, timeout=10, session=None, cache=None,
+                 resizer=None):
         super().__init__(md)
         self.markdown_file_dir = markdown_file_dir
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.session = session
+        self.cache = cache  # Optional image_cache.ImageCache
+        self.resizer = resizer  # Optional ImageResizer
+        self.variant = resizer.variant if resizer else ""
+
+    @staticmethod
+    def encode(image_data, image_ext):
+        encoded_string = base64.b64encode(image_data).decode()
+        return f"data:image/{image_ext};base64,{encoded_string}"
+
+    def embed(self, image_data, image_ext):
+        if self.resizer is not None:
+            image_data, image_ext = self.resizer(image_data, image_ext)
+        return self.encode(image_data, image_ext)
+
+    def local_data_url(self, full_image_path):
+        image_ext = os.path.splitext(full_image_path)[1][1:]  # Extension from local file
+        if self.cache is None:
+            with open(full_image_path, "rb") as image_file:
+                return self.embed(image_file.read(), image_ext)
+
+        key = self.cache.local_key(full_image_path, self.variant)
+        validators = self.cache.local_validators(full_image_path)
+        data_url = self.cache.get(key, **validators)
+        if data_url is None:
+            with open(full_image_path, "rb") as image_file:
+                data_url = self.embed(image_file.read(), image_ext)
+            self.cache.put(key, data_url, **validators)
+        return data_url
+
+    def get_session(self):
+        # One pooled session for all downloads, kept between documents
+        import requests
+        import requests.adapters
+        if self.session is None:
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=self.max_workers, pool_maxsize=self.max_workers
+            )
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+        return self.session
+
+    def fetch_remote_images(self, lines):
+        # Scan the document first and download every remote image concurrently
+        return self.fetch_urls(
+            m.group(2) for line in lines for m in self.IMAGE_RE.finditer(line)
+        )
+
+    def fetch_urls(self, paths):
+        # Download the remote images among paths, returns {url: data URL or None}
+        urls = sorted({path for path in paths if path.startswith(self.REMOTE_PREFIXES)})
+        if not urls:
+            return {}
+        import requests
+        session = self.get_session()
+
+        def fetch(url):
+            full_url = url if url.startswith(("http://", "https://")) else "https://" + url
+            key = self.cache.remote_key(url, self.variant) if self.cache else None
+            headers = self.cache.request_headers(key) if self.cache else {}
+            try:
+                response = session.get(full_url, timeout=self.timeout, headers=headers)
+                if response.status_code == 304:
+                    data_url = self.cache.get(key)
+                    if data_url is not None:
+                        return data_url
+                    response = session.get(full_url, timeout=self.timeout)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                print(f"Could not fetch image {url}: {e}")
+                return None
+
+            image_ext = os.path.splitext(url)[1][1:]  # Extension from URL
+            data_url = self.embed(response.content, image_ext)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if self.cache and (etag or last_modified):
+                self.cache.put(key, data_url, etag=etag, last_modified=last_modified)
+            return data_url
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls))) as pool:
+            return dict(zip(urls, pool.map(fetch, urls)))
 
     def run(self, lines):
+        remote_images = self.fetch_remote_images(lines)
+
         def repl(m):
-            alt_text = m.group(1)
-            image_path = m.group(2)
-            image_data = None
-            image_ext = None
-
-            if image_path.startswith(("http://", "https://", "www")):
-                response = requests.get(image_path)
-                image_data = response.content
-                image_ext = os.path.splitext(image_path)[1][1:]  # Extension from URL
-            else:
-                # Resolve relative path for local files
-                full_image_path = os.path.join(self.markdown_file_dir, image_path)
-                if os.path.exists(full_image_path):
-                    with open(full_image_path, "rb") as image_file:
-                        image_data = image_file.read()
-                    image_ext = os.path.splitext(full_image_path)[1][1:]  # Extension from local file
-                else:
-                    return m.group()  # Return original markdown if file not found
-
-            # Encode the image data
-            encoded_string = base64.b64encode(image_data).decode()
-            data_url = f"data:image/{image_ext};base64,{encoded_string}"
-
-            table = etree.Element(
-                "table",
-                attrib={
-                    "align": "center",
-                    "cellpadding": "0",
-                    "cellspacing": "0",
-                    "class": "tr-caption-container",
-                    "style": "margin-left: auto; margin-right: auto;",
-                },
-            )
-            tbody = etree.SubElement(table, "tbody")
-            tr1 = etree.SubElement(tbody, "tr")
-            td1 = etree.SubElement(tr1, "td", attrib={"style": "text-align: center;"})
-            img = etree.SubElement(
-                td1, "img", attrib={"border": "0", "src": data_url, "width": "500"}
-            )
-            tr2 = etree.SubElement(tbody, "tr")
-            td2 = etree.SubElement(
-                tr2,
-                "td",
-                attrib={"class": "tr-caption", "style": "text-align: center;"},
-            )
-            soup = BeautifulSoup(markdown.markdown(alt_text), features="html.parser")
-            td2.text = ''.join(soup.stripped_strings)  # Extracts all text from the rendered Markdown, discarding the tags
-            
-            # Convert the element to a string and return
-            return etree.tostring(table, encoding="unicode")
+            table = self.render_image(m.group(1), m.group(2), remote_images)
+            return m.group() if table is None else table
 
         new_lines = []
         for line in lines:
             new_line = self.IMAGE_RE.sub(repl, line)
             new_lines.append(new_line)
 
+        if self.cache is not None:
+            self.cache.save()
         return new_lines
 
+    def render_image(self, alt_text, image_path, remote_images):
+        # Captioned <table> with the embedded image, None if the image is not available
+        if image_path.startswith(self.REMOTE_PREFIXES):
+            data_url = remote_images.get(image_path)
+            if data_url is None:
+                return None  # Download failed
+        else:
+            # Resolve relative path for local files
+            full_image_path = os.path.join(self.markdown_file_dir, image_path)
+            if os.path.exists(full_image_path):
+                data_url = self.local_data_url(full_image_path)
+            else:
+                return None  # File not found
+
+        table = etree.Element(
+            "table",
+            attrib={
+                "align": "center",
+                "cellpadding": "0",
+                "cellspacing": "0",
+                "class": "tr-caption-container",
+                "style": "margin-left: auto; margin-right: auto;",
+            },
+        )
+        tbody = etree.SubElement(table, "tbody")
+        tr1 = etree.SubElement(tbody, "tr")
+        td1 = etree.SubElement(tr1, "td", attrib={"style": "text-align: center;"})
+        img = etree.SubElement(
+            td1, "img", attrib={"border": "0", "src": data_url, "width": "500"}
+        )
+        tr2 = etree.SubElement(tbody, "tr")
+        td2 = etree.SubElement(
+            tr2,
+            "td",
+            attrib={"class": "tr-caption", "style": "text-align: center;"},
+        )
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(markdown.markdown(alt_text), features="html.parser")
+        td2.text = ''.join(soup.stripped_strings)  # Extracts all text from the rendered Markdown, discarding the tags
+        
+        # Convert the element to a string and return
+        return etree.tostring(table, encoding="unicode")
+
 class ImageExtension(Extension):
-    def __init__(self, markdown_file_dir):
+    def __init__(self, markdown_file_dir, **options):
         self.markdown_file_dir = markdown_file_dir
+        self.options = options  # max_workers, timeout, session, cache, resizer
 
     def extendMarkdown(self, md):
-        image_preprocessor = ImagePreprocessor(md, self.markdown_file_dir)
+        image_preprocessor = ImagePreprocessor(md, self.markdown_file_dir, **self.options)
         md.preprocessors.register(image_preprocessor, "image_preprocessor", 125)
         md.preprocessors.deregister("html_block")
 
@@ -275,7 +475,8 @@ class LatexPreprocessor(Preprocessor):
     def __init__(self, md):
         super().__init__(md)
 
-    def process_latex_content(self, text):
+    @staticmethod
+    def process_latex_content(text):
         # Replacing specific LaTeX commands using regular expressions
         replacements = {
             r'\\\\': r'\\\\\\\\',
@@ -372,10 +573,15 @@ class EmojiPreprocessor(Preprocessor):
         super().__init__(md)
 
     def run(self, lines):
+        # Only lines with a ':' can hold an emoji alias
+        if not any(':' in line for line in lines):
+            return lines
+        import emoji
         new_lines = []
         for line in lines:
-            line = emoji.emojize(line)  # Convert text-based emojis
-            #line = emoji.demojize(line)
+            if ':' in line:
+                line = emoji.emojize(line)  # Convert text-based emojis
+                #line = emoji.demojize(line)
             new_lines.append(line)
         return new_lines
 
@@ -383,6 +589,166 @@ class EmojiExtension(Extension):
     def extendMarkdown(self, md):
         md.preprocessors.register(EmojiPreprocessor(md), "emoji_preprocessor", 175)
 
+class FusedPreprocessor(Preprocessor):
+    """Code blocks, inline code, LaTeX, images, emoji and (optionally) raw
+    links in a single pass over the document.
+
+    The document is tokenized once into fenced code, inline code, math, image
+    and text regions and each region only goes through its own transform.
+    Rendered code, math and images are put in Markdown's HTML stash and only
+    a placeholder is left in the text, so Markdown's inline patterns (emphasis,
+    escapes) cannot mangle their contents. Text without a
+    '`', '$' or '![' is not scanned for spans, and emoji/link substitution
+    only runs on text that can contain them."""
+    # Every branch starts with a literal so the regex engine can skip ahead
+    # to the next '`', '$' or '!' instead of trying each branch at every
+    # position. Math is the same as LatexPreprocessor's \$\$.*?\$\$|\$.*?\$
+    SPAN_RE = re.compile(
+        r"`(?P<code>(?s:.+?))`"
+        r"|\$(?s:\$.*?\$\$|.*?\$)"
+        r"|!\[(?P<alt>.*?)\]\((?P<src>.*?)\)"
+    )
+
+    def __init__(self, md, markdown_file_dir, raw_links=False, **image_options):
+        super().__init__(md)
+        self.images = ImagePreprocessor(md, markdown_file_dir, **image_options)
+        self.raw_links = raw_links
+
+    @staticmethod
+    def split_blocks(lines):
+        # [("code_block", (lang, code)) or ("text", text)], same fence rules as CodeBlockPreprocessor
+        if not any(line.startswith('```') for line in lines):
+            return [("text", '\n'.join(lines))] if lines else []
+        blocks = []
+        text = []
+        code_block = None
+        for line in lines:
+            if code_block is not None:
+                if line.startswith('```') and CodeBlockPreprocessor.END_CODE_BLOCK_RE.match(line):
+                    blocks.append(("code_block", (lang, '\n'.join(code_block))))
+                    code_block = None
+                else:
+                    code_block.append(line)
+                continue
+            match = line.startswith('```') and CodeBlockPreprocessor.CODE_BLOCK_RE.match(line)
+            if match:
+                if text:
+                    blocks.append(("text", '\n'.join(text)))
+                    text = []
+                lang = match.group(1) or 'text'
+                code_block = []
+            else:
+                text.append(line)
+        if text:
+            blocks.append(("text", '\n'.join(text)))
+        # If code block wasn't closed
+        if code_block:
+            blocks.append(("code_block", (lang, '\n'.join(code_block))))
+        return blocks
+
+    def split_spans(self, text):
+        # [(kind, value)] with kind "text", "inline", "math" or "image"
+        if '`' not in text and '$' not in text and '![' not in text:
+            return [("text", text)]
+        spans = []
+        pos = 0
+        for m in self.SPAN_RE.finditer(text):
+            if m.start() > pos:
+                spans.append(("text", text[pos:m.start()]))
+            if m.group("code") is not None:
+                spans.append(("inline", m.group("code")))
+            elif m.group("alt") is None:
+                spans.append(("math", m.group()))
+            else:
+                spans.append(("image", (m.group("alt"), m.group("src"))))
+            pos = m.end()
+        if pos < len(text):
+            spans.append(("text", text[pos:]))
+        return spans
+
+    def render_text(self, text):
+        if ':' in text:
+            import emoji
+            text = emoji.emojize(text)  # Convert text-based emojis
+        if self.raw_links and 'http' in text:
+            text = RawLinkPreprocessor(self.md).run([text])[0]
+        return text
+
+    def render_spans(self, spans, remote_images, stash=True):
+        # Rendered pieces of a text block, join them for the text. With stash
+        # the HTML of code, math and images is stashed and its placeholder
+        # returned; without it the pieces are Markdown as LatexPreprocessor and
+        # friends produce, as needed for the image captions
+        out = []
+        for kind, value in spans:
+            if kind == "text":
+                out.append(self.render_text(value))
+            elif kind == "inline":
+                html = render_inline_code(value)
+                out.append(self.md.htmlStash.store(html) if stash else html)
+            elif kind == "math":
+                if stash:
+                    out.append(self.md.htmlStash.store(value.translate(HTML_ESCAPE_TABLE)))
+                else:
+                    out.append(LatexPreprocessor.process_latex_content(value))
+            else:
+                alt, src = value
+                alt_text = ''.join(self.render_spans(self.split_spans(alt), remote_images, stash=False))
+                table = self.images.render_image(alt_text, src, remote_images)
+                if table is None:
+                    out.append(f"![{alt_text}]({src})")
+                else:
+                    out.append(self.md.htmlStash.store(table) if stash else table)
+        return out
+
+    def run(self, lines):
+        blocks = [
+            (kind, value if kind == "code_block" else self.split_spans(value))
+            for kind, value in self.split_blocks(lines)
+        ]
+        # Download every remote image concurrently before rendering
+        remote_images = self.images.fetch_urls(
+            span[1][1]
+            for kind, spans in blocks if kind == "text"
+            for span in spans if span[0] == "image"
+        )
+
+        new_lines = []
+        for kind, value in blocks:
+            if kind == "code_block":
+                # A paragraph of its own, so the placeholder's <p> is dropped
+                new_lines.extend(['', self.md.htmlStash.store(render_code_block(*value)), ''])
+                continue
+            pieces = self.render_spans(value, remote_images)
+            # Split into lines piece by piece, the embedded images are not copied again
+            line = []
+            for piece in pieces:
+                if '\n' in piece:
+                    first, *rest = piece.split('\n')
+                    new_lines.append(''.join(line + [first]))
+                    new_lines.extend(rest[:-1])
+                    line = [rest[-1]]
+                else:
+                    line.append(piece)
+            new_lines.append(''.join(line))
+
+        if self.images.cache is not None:
+            self.images.cache.save()
+        return new_lines
+
+class FusedExtension(Extension):
+    def __init__(self, markdown_file_dir, raw_links=False, **options):
+        self.markdown_file_dir = markdown_file_dir
+        self.raw_links = raw_links
+        self.options = options  # ImagePreprocessor options
+
+    def extendMarkdown(self, md):
+        fused = FusedPreprocessor(md, self.markdown_file_dir, self.raw_links, **self.options)
+        # After normalize_whitespace (30), which strips the stash placeholders'
+        # markers, and before fenced_code_block (25)
+        md.preprocessors.register(fused, "fused", 29)
+        md.preprocessors.deregister("html_block")
+
 class ReferencesIdTreeprocessor(Treeprocessor):
     def run(self, root):
         for element in root.iter():
@@ -418,11 +784,27 @@ class StylingPostprocessor(Postprocessor):
 
         return "".join(parts)
 
+    @staticmethod
+    def style_paragraphs(soup):
+        # Same as format_text on a parsed document: justify until the
+        # "References" or "Footnotes" heading, small left-aligned text after
+        style = 'text-align: justify;'
+        for tag in soup.find_all(re.compile(r'^(p|h[1-6])$')):
+            if tag.name == 'p':
+                if not tag.attrs:
+                    tag['style'] = style
+            elif tag.get('id') == 'references' or (
+                not tag.attrs and tag.get_text().startswith('Footnotes')
+            ):
+                style = 'text-align: left; font-size: 12px;'
+
 class StylingExtension(Extension):
     def extendMarkdown(self, md):
         md.postprocessors.register(StylingPostprocessor(md), "styling", 175)
 
 class IncludeHTMLPostprocessor(Postprocessor):
+    INCLUDE_RE = re.compile(r'\{\{\s*include\s+(.*?)\s*\}\}')
+
     def run(self, text):
         def replace_include(match):
             filename = match.group(1)
@@ -435,44 +817,115 @@ class IncludeHTMLPostprocessor(Postprocessor):
                 return match.group(0)
         
         # Use re.sub to find the pattern and replace it by reading the file content
-        new_text = re.sub(r'\{\{\s*include\s+(.*?)\s*\}\}', replace_include, text)
+        new_text = self.INCLUDE_RE.sub(replace_include, text)
         return new_text
 
+    @classmethod
+    def include_files(cls, soup):
+        from bs4 import BeautifulSoup, NavigableString
+        # Replace placeholders inside text nodes with the parsed file content
+        for node in soup.find_all(string=cls.INCLUDE_RE):
+            pieces = cls.INCLUDE_RE.split(str(node))
+            new_nodes = []
+            for k, piece in enumerate(pieces):
+                if k % 2 == 0:
+                    if piece:
+                        new_nodes.append(NavigableString(piece))
+                    continue
+                try:
+                    with open(piece, 'r') as f:
+                        fragment = BeautifulSoup(f.read(), 'html.parser')
+                    new_nodes.extend(list(fragment.contents))
+                except FileNotFoundError:
+                    new_nodes.append(NavigableString('{{ include %s }}' % piece))
+            node.replace_with(*new_nodes)
+
 class IncludeHTMLExtension(Extension):
     def extendMarkdown(self, md):
         md.postprocessors.register(IncludeHTMLPostprocessor(md), 'include_html', 25)
 
-def process(infile):
-    markdown_file_dir = os.path.dirname(os.path.abspath(infile))
+class DOMPostprocessor(Postprocessor):
+    """Link previews, paragraph styling, includes and table classes on a
+    single parse of the document instead of one BeautifulSoup/regex pass
+    per stage. Runs after the raw HTML has been restored."""
 
-    with open(infile, "r") as f:
-        text = f.read()
-    html = markdown.markdown(
-        text,
+    def run(self, text):
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(text, 'html.parser')
+        LinkPreviewPostprocessor.add_previews(soup)
+        StylingPostprocessor.style_paragraphs(soup)
+        IncludeHTMLPostprocessor.include_files(soup)
+        TableClassPostprocessor.add_table_class(soup)
+        return str(soup)
+
+class DOMExtension(Extension):
+    def extendMarkdown(self, md):
+        md.postprocessors.register(DOMPostprocessor(md), 'dom', 5)
+
+def create_markdown(image_cache=None, image_resizer=None):
+    # A configured Markdown instance that can convert many documents,
+    # see convert()
+    return markdown.Markdown(
         extensions=[
-            CodeBlockExtension(),
-            LatexExtension(),
+            # Code blocks, inline code, LaTeX, images and emoji
+            FusedExtension(None, cache=image_cache, resizer=image_resizer),
             "fenced_code",
             "tables",
             "footnotes",
             "admonition",
-            ImageExtension(markdown_file_dir),
             MetaDataExtension(),
             ReferencesIdExtension(),
-            StylingExtension(),
-            EmojiExtension(),
-            LinkPreviewExtension(),
-            IncludeHTMLExtension(),
             CustomCSSExtension(),
-            TableClassExtension()
+            DOMExtension()
         ],
         extension_configs={"footnotes": {"PLACE_MARKER" : "///Footnotes///"}},
     )
-    return html
+
+def convert(md, infile):
+    # Convert one file with a Markdown instance from create_markdown()
+    md.reset()
+    md.preprocessors["fused"].images.markdown_file_dir = os.path.dirname(os.path.abspath(infile))
+    with open(infile, "r") as f:
+        text = f.read()
+    return md.convert(text)
+
+def post_dependencies(infile):
+    # Local files a post is built from: the post itself, its local images
+    # and the files pulled in with {{ include ... }}
+    markdown_file_dir = os.path.dirname(os.path.abspath(infile))
+    with open(infile, "r") as f:
+        text = f.read()
+    deps = [os.path.abspath(infile)]
+    for m in ImagePreprocessor.IMAGE_RE.finditer(text):
+        if not m.group(2).startswith(ImagePreprocessor.REMOTE_PREFIXES):
+            deps.append(os.path.join(markdown_file_dir, m.group(2)))
+    for m in IncludeHTMLPostprocessor.INCLUDE_RE.finditer(text):
+        deps.append(os.path.abspath(m.group(1)))
+    return list(dict.fromkeys(deps))
+
+def process(infile, image_cache=None, image_resizer=None):
+    md = create_markdown(image_cache=image_cache, image_resizer=image_resizer)
+    return convert(md, infile)
 
 if __name__ == "__main__":
-    infile = sys.argv[1]
-    outfile = sys.argv[2]
-    html = process(infile)
+    parser = argparse.ArgumentParser(description='Convert a Markdown post to Blogger HTML.')
+    parser.add_argument('infile', help='Input Markdown file')
+    parser.add_argument('outfile', help='Output HTML file')
+    parser.add_argument('--cache-dir', help='Directory for the persistent image cache')
+    parser.add_argument('--shrink-images', action='store_true',
+                        help='Resize images to their display width and recompress (needs Pillow)')
+    parser.add_argument('--dpi-factor', type=float, default=2.0,
+                        help='Pixels per displayed pixel kept when shrinking images')
+    parser.add_argument('--image-format', default='webp', choices=['webp', 'png', 'jpeg', 'same'],
+                        help='Format of shrunk images')
+    args = parser.parse_args()
+    infile = args.infile
+    outfile = args.outfile
+    image_cache = ImageCache(args.cache_dir) if args.cache_dir else None
+    image_resizer = None
+    if args.shrink_images:
+        image_format = None if args.image_format == 'same' else args.image_format
+        image_resizer = ImageResizer(dpi_factor=args.dpi_factor, image_format=image_format)
+    html = process(infile, image_cache=image_cache, image_resizer=image_resizer)
     with open(outfile, "w") as f:
         f.write(html)
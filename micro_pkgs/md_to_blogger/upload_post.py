@@ -1,17 +1,22 @@
 import argparse
 import datetime
+import hashlib
+import json
 import os
 import pickle
 import sys
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-import md_to_html_v2 as md_to_html
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# The Google API client stack and the converter are imported where they are
+# used so that argument parsing (and --help) starts fast.
 
 # If modifying these SCOPES, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/blogger']
 
 def get_credentials(token_file, client_secrets_file):
+    from google.auth.transport.requests import Request
+    from google_auth_oauthlib.flow import InstalledAppFlow
     creds = None
     if os.path.exists(token_file):
         with open(token_file, 'rb') as token:
@@ -27,13 +32,8 @@ def get_credentials(token_file, client_secrets_file):
             pickle.dump(creds, token)
     return creds
 
-def upload_blog_post(html_file, title, pub_date, blog_id, client_secrets_file, token_file, draft=True):
-    # Get valid credentials
-    credentials = get_credentials(token_file, client_secrets_file)
-
-    # Create a service object
-    service = build('blogger', 'v3', credentials=credentials)
-
+def upload_blog_post(html_file, title, pub_date, blog_id, client_secrets_file, token_file, draft=True,
+                     source=None, state_file='upload_state.json'):
     # Read the HTML file.
     with open(html_file, 'r') as f:
         html_content = f.read()
@@ -44,17 +44,253 @@ def upload_blog_post(html_file, title, pub_date, blog_id, client_secrets_file, t
         'content': html_content,
     }
 
-    # Call the `insert` method of the `BlogPosts` service to insert the post into your blog.
-    if draft:
-        response = service.posts().insert(blogId=blog_id,isDraft=True,body=post).execute()
-    else:
-        response = service.posts().publish(blogId=blog_id,publishDate=pub_date,body=post).execute()
+    # Posts uploaded before are patched with their changed fields, or not sent at all
+    state = UploadState(state_file)
+    source = source or html_file
+    entry = state.get(source, os.path.abspath(source))
+    source = state.key(source)
+    if entry is not None and not changed_fields(entry, post):
+        print('Post ID:', entry['post_id'], '(unchanged, not uploaded)')
+        return entry['post_id']
+
+    client = BloggerClient(blog_id, client_secrets_file, token_file)
+    status, post_id = sync_post(client, state, source, post, draft=draft, publish_date=pub_date)
 
     # Print the ID of the inserted post.
-    print('Post ID:', response['id'])
+    print('Post ID:', post_id, f'({status})')
+    return post_id
+
+class BloggerClient:
+    """Blogger API service shared by all upload threads.
+
+    The service object is built once; each thread gets its own (authorized)
+    httplib2.Http since httplib2 is not thread-safe. Requests are retried up
+    to num_retries times with exponential backoff on rate limits (429, 403
+    rateLimitExceeded) and 5xx responses. api_endpoint points the client at
+    another server, e.g. blogger_mock.py, and skips the OAuth flow."""
+
+    def __init__(self, blog_id, client_secrets_file=None, token_file='token.pickle',
+                 api_endpoint=None, num_retries=6, timeout=60):
+        from googleapiclient.discovery import build
+        self.blog_id = blog_id
+        self.num_retries = num_retries
+        self.timeout = timeout
+        self.local = threading.local()
+        self.credentials = None if api_endpoint else get_credentials(token_file, client_secrets_file)
+        client_options = {'api_endpoint': api_endpoint} if api_endpoint else None
+        self.service = build('blogger', 'v3', http=self.http(), client_options=client_options)
+
+    def http(self):
+        if not hasattr(self.local, 'http'):
+            import httplib2
+            http = httplib2.Http(timeout=self.timeout)
+            if self.credentials is not None:
+                import google_auth_httplib2
+                http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=http)
+            self.local.http = http
+        return self.local.http
+
+    def execute(self, request):
+        return request.execute(http=self.http(), num_retries=self.num_retries)
+
+    # Responses are limited to the post ID so the (large) content is not sent back
+    def insert(self, post, draft=True):
+        return self.execute(self.service.posts().insert(
+            blogId=self.blog_id, isDraft=draft, body=post, fields='id'))
+
+    def patch(self, post_id, fields):
+        return self.execute(self.service.posts().patch(
+            blogId=self.blog_id, postId=post_id, body=fields, fields='id'))
+
+class UploadState:
+    """Post ID, title and content hash of each uploaded source file, stored
+    as JSON and saved after every upload so an interrupted run resumes where
+    it stopped. The file also keeps build_site.Manifest's file hash cache."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            data = {}
+        self.posts = data.get('posts', {})
+        self.files = data.get('files', {})
+
+    def key(self, source):
+        # Source path relative to the state file's directory, so the state
+        # stays valid when the checkout is moved or cloned elsewhere
+        base = os.path.dirname(os.path.abspath(self.path))
+        return os.path.relpath(os.path.abspath(source), base).replace(os.sep, '/')
+
+    def get(self, source, *aliases):
+        # Entry of source, also found (and re-keyed) under older keys such as
+        # absolute paths
+        key = self.key(source)
+        with self.lock:
+            if key not in self.posts:
+                for alias in aliases:
+                    if alias in self.posts:
+                        self.posts[key] = self.posts.pop(alias)
+                        break
+            return self.posts.get(key)
+
+    def update(self, rel, entry):
+        with self.lock:
+            self.posts[rel] = entry
+            self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'posts': self.posts, 'files': self.files}, f, indent=1)
+        os.replace(tmp, self.path)
+
+def content_hash(html):
+    return hashlib.sha256(html.encode()).hexdigest()
+
+def changed_fields(entry, post):
+    # Fields of post that differ from the last upload recorded in entry
+    fields = {}
+    if entry.get('title') != post['title']:
+        fields['title'] = post['title']
+    if entry.get('content_hash') != content_hash(post['content']):
+        fields['content'] = post['content']
+    return fields
+
+def sync_post(client, state, source, post, draft=True, publish_date=None, **extra):
+    """Insert the post for source, or patch the uploaded one with only the
+    fields that changed. publish_date (RFC 3339) schedules new non-draft
+    posts, extra is stored with the state entry.
+
+    Returns (status, post ID) with status 'inserted', 'updated' or 'unchanged'."""
+    entry = state.posts.get(source)
+    if entry is None:
+        body = dict(post, published=publish_date) if publish_date and not draft else post
+        post_id = client.insert(body, draft)['id']
+        status = 'inserted'
+    else:
+        post_id = entry['post_id']
+        fields = changed_fields(entry, post)
+        status = 'updated' if fields else 'unchanged'
+        if fields:
+            client.patch(post_id, fields)
+    state.update(source, {
+        'post_id': post_id,
+        'title': post['title'],
+        'content_hash': content_hash(post['content']),
+        **extra,
+    })
+    return status, post_id
+
+def post_title(infile):
+    # `<!-- META: title=... -->`, else the first level-1 heading, else the file name
+    with open(infile, 'r') as f:
+        for line in f:
+            if line.startswith('<!-- META:') and 'title=' in line:
+                return line.split('title=', 1)[1].split(',')[0].replace('-->', '').strip()
+            if line.startswith('# '):
+                return line[2:].strip()
+    return os.path.splitext(os.path.basename(infile))[0]
+
+def upload_posts(src_dir, client, state_file, workers=4, draft=True, out_dir=None, cache_dir=None,
+                 exclude=("README.md",), force=False):
+    """Convert every post under src_dir and upload it with at most `workers`
+    uploads in flight. Posts are matched to their blog post through the
+    state file: new posts are inserted, changed posts are updated with
+    `patch` and posts whose source, images, includes, title and converter
+    are unchanged are skipped without being converted. Changed posts are
+    patched with only the fields that differ; a rendered post identical to
+    the uploaded one is not sent.
+
+    Returns {relative source path: 'inserted', 'updated', 'unchanged', 'skipped' or 'failed'}."""
+    import build_site
+    import md_to_html_v2 as md_to_html
+    from image_cache import ImageCache
+
+    state = UploadState(state_file)
+    hashes = build_site.Manifest(os.devnull)
+    hashes.files = state.files  # File hash cache saved with the state
+    converter = build_site.converter_hash(cache_dir=cache_dir)
+    md = md_to_html.create_markdown(image_cache=ImageCache(cache_dir) if cache_dir else None)
+    slots = threading.BoundedSemaphore(workers)  # Bounds converted posts held in memory
+    results = {}
+
+    def upload(rel, source, post, source_hash):
+        try:
+            results[rel], post_id = sync_post(client, state, source, post, draft=draft,
+                                              source_hash=source_hash)
+        except Exception as e:
+            results[rel] = 'failed'
+            print(f"failed {rel}: {e}")
+        else:
+            print(f"{results[rel]} {rel} (post {post_id})")
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for infile in build_site.find_posts(src_dir, exclude):
+            rel = os.path.relpath(infile, src_dir)
+            source = state.key(infile)
+            with state.lock:
+                post_hash = hashes.post_hash(infile)
+            source_hash = hashlib.sha256((converter + post_hash).encode()).hexdigest()
+            title = post_title(infile)
+            entry = state.get(infile, rel, os.path.abspath(infile)) or {}
+            if not force and entry.get('source_hash') == source_hash and entry.get('title') == title:
+                results[rel] = 'skipped'
+                continue
+
+            html = md_to_html.convert(md, infile)
+            if out_dir:
+                outfile = build_site.output_path(src_dir, out_dir, infile)
+                os.makedirs(os.path.dirname(outfile), exist_ok=True)
+                with open(outfile, 'w') as f:
+                    f.write(html)
+            slots.acquire()
+            pool.submit(upload, rel, source, {'title': title, 'content': html}, source_hash)
+    state.save()
+
+    counts = {}
+    for status in results.values():
+        counts[status] = counts.get(status, 0) + 1
+    print(', '.join(f"{n} {status}" for status, n in sorted(counts.items())) or 'No posts found')
+    return results
+
+def bulk_main(argv):
+    parser = argparse.ArgumentParser(prog='upload_post.py bulk',
+                                     description='Convert and upload a directory of posts.')
+    parser.add_argument('src_dir', help='Directory with Markdown posts')
+    parser.add_argument('client_secrets_file', help='Client secrets file')
+    parser.add_argument('blogid', help='Blog ID')
+    parser.add_argument('--state', default='upload_state.json',
+                        help='State file mapping posts to blog post IDs and content hashes')
+    parser.add_argument('-j', '--workers', type=int, default=4, help='Concurrent uploads')
+    parser.add_argument('--publish', action='store_true', help='Publish new posts instead of saving drafts')
+    parser.add_argument('--force', action='store_true', help='Upload unchanged posts too')
+    parser.add_argument('--out-dir', help='Also write the HTML files to this directory')
+    parser.add_argument('--exclude', nargs='*', default=['README.md'], help='File name patterns to skip')
+    parser.add_argument('--cache-dir', help='Directory for the persistent image cache')
+    parser.add_argument('--api-endpoint', help='Use another API server, e.g. blogger_mock.py')
+    args = parser.parse_args(argv)
+
+    client = BloggerClient(args.blogid, args.client_secrets_file, 'token.pickle', api_endpoint=args.api_endpoint)
+    results = upload_posts(args.src_dir, client, args.state, workers=args.workers, draft=not args.publish,
+                           out_dir=args.out_dir, cache_dir=args.cache_dir, exclude=args.exclude,
+                           force=args.force)
+    if 'failed' in results.values():
+        sys.exit(1)
 
 def main():
-    parser = argparse.ArgumentParser(description='Upload a blog post.')
+    if len(sys.argv) > 1 and sys.argv[1] == 'bulk':
+        return bulk_main(sys.argv[2:])
+    parser = argparse.ArgumentParser(description='Upload a blog post. Use `upload_post.py bulk -h` '
+                                                 'to upload a directory of posts.')
     parser.add_argument('infile', help='Input Markdown file')
     parser.add_argument('outfile', help='Output HTML file')
     parser.add_argument('title', help='Blog post title')
@@ -63,17 +299,24 @@ def main():
     parser.add_argument('--date', default=datetime.datetime.now().strftime('%A, %B %d, %Y'),
                         help='Publish date in any format (default: today\'s date)')
     parser.add_argument('--draft', default=True, type=bool, help='Publish as draft or not')
+    parser.add_argument('--cache-dir', help='Directory for the persistent image cache')
+    parser.add_argument('--state', default='upload_state.json',
+                        help='State file mapping posts to blog post IDs and content hashes')
     args = parser.parse_args()
 
-    # Parse date and convert it to the required format
+    # Parse date and convert it to the RFC 3339 format of the API
     parsed_date = datetime.datetime.strptime(args.date, '%A, %B %d, %Y')
-    formatted_date = parsed_date.strftime('%A, %B %d, %Y')
+    formatted_date = parsed_date.astimezone().isoformat()
 
-    html = md_to_html.process(args.infile)
+    import md_to_html_v2 as md_to_html
+    from image_cache import ImageCache
+    image_cache = ImageCache(args.cache_dir) if args.cache_dir else None
+    html = md_to_html.process(args.infile, image_cache=image_cache)
     with open(args.outfile, 'w') as f:
         f.write(html)
 
-    upload_blog_post(args.outfile, args.title, formatted_date, args.blogid, args.client_secrets_file, 'token.pickle', args.draft)
+    upload_blog_post(args.outfile, args.title, formatted_date, args.blogid, args.client_secrets_file, 'token.pickle',
+                     args.draft, source=args.infile, state_file=args.state)
 
 if __name__ == '__main__':
     main()
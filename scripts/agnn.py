@@ -22,6 +22,13 @@
 # ]
 # ///
 
+from multiprocessing import shared_memory
+import multiprocessing as mp
+import json
+import os
+import queue
+import threading
+
 from ase.neighborlist import neighbor_list
 from ase.data import covalent_radii
 from load_atoms import load_dataset
@@ -29,6 +36,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 from mendeleev import element
 
+# Bessel functions in the pair basis (after the num_centers Gaussians)
+NUM_BESSEL = 3
+
 # Use cache to speed feature assignment
 print("Loading element data...")
 ELEMENT_CACHE = {}
@@ -82,25 +92,58 @@ def normalize_features(X: np.ndarray) -> np.ndarray:
     return (X - mean) / std
 
 
-def create_node_features(
-    atoms, cutoff: float, num_centers: int = 8
-) -> tuple:
-    """Create node features: atomic number, mass, covalent radius, basis
-    expansion.
+def normalize_features_backward(X: np.ndarray, G: np.ndarray) -> np.ndarray:
+    """Chain rule through `normalize_features`.
 
-    When we first feed inputs into the GNN, we need to create node(edge)
-    features. This is just a vector, matrix, tensor of features that is tied
-    to each node(edge) on the graph. This is what we are trying to learn,
-    that is which of these features are important on a node(edge) based on
-    the graph structure and information passed from neighboring nodes(edges).
+    Given the raw features X and G = dE/dX_norm returns dE/dX, including the
+    dependence of the column mean and standard deviation on every row.
+    """
+    n = X.shape[0]
+    Xc = X - X.mean(axis=0)
+    sigma = X.std(axis=0)
+    std = sigma + 1e-8
+    safe_sigma = np.where(sigma > 0, sigma, 1.0)
+    return (G - G.mean(axis=0)) / std - Xc * (G * Xc).sum(axis=0) / (
+        n * safe_sigma * std**2
+    )
 
-    Most of MLIPs are actually focused on the best set of node(edge) feature
-    representations. A lot is centered around basis expansions and the update
-    of the functions for the features. In this function we are just using
-    basic atom properties and expanding the pair-wise distances into sampling
-    of basis functions (radial and bessel functions).
+
+def basis_expansion(
+    d: np.ndarray,
+    cutoff: float,
+    num_centers: int = 8,
+    num_bessel: int = NUM_BESSEL,
+    derivative: bool = False,
+):
+    """Expand pair distances into radial (Gaussian) and bessel basis values.
+
+    Returns an array of shape (n_pairs, num_centers + num_bessel) and, if
+    `derivative` is set, also its derivative with respect to the distance.
+    """
+    centers = np.linspace(0.0, cutoff, num_centers)
+    width = 2 / 3 * (cutoff / num_centers)
+    k = np.linspace(np.pi / num_bessel, np.pi, num_bessel)
+    delta = d[:, None] - centers
+    rbf_features = np.exp(-(delta**2) / (2 * width**2))
+    sin_kd = np.sin(d[:, None] * k)
+    inv_d = 1.0 / (d[:, None] + 1e-8)
+    bessel_funcs = sin_kd * inv_d
+    basis_features = np.hstack((rbf_features, bessel_funcs))
+    if not derivative:
+        return basis_features
+
+    d_rbf = -delta / width**2 * rbf_features
+    d_bessel = k * np.cos(d[:, None] * k) * inv_d - sin_kd * inv_d**2
+    return basis_features, np.hstack((d_rbf, d_bessel))
+
+
+def raw_node_features(
+    atoms, i: np.ndarray, d: np.ndarray, cutoff: float, num_centers: int = 8
+) -> tuple:
+    """Unnormalized node features and the neighbor count of each atom.
+
+    See `create_node_features` for what the features are.
     """
-    i, j, d = neighbor_list("ijd", atoms, cutoff)
     n_atoms = len(atoms)
 
     # Atomic properties
@@ -110,19 +153,12 @@ def create_node_features(
     nvalence = np.array([ELEMENT_CACHE[z]["nvalence"] for z in atomic_nums])
 
     # Compute radial basis expansion for each pair i-j
-    centers = np.linspace(0.0, cutoff, num_centers)
-    width = 2 / 3 * (cutoff / num_centers)
-    num_bessel = 3
-    rbf_features = np.exp(-((d[:, None] - centers) ** 2) / (2 * width**2))
-    bessel_funcs = np.sin(
-        d[:, None] * np.linspace(np.pi / num_bessel, np.pi, num_bessel)
-    ) / (d[:, None] + 1e-8)
-    basis_features = np.hstack((rbf_features, bessel_funcs))
+    basis_features = basis_expansion(d, cutoff, num_centers)
 
     # We need to combine the contributions of all
     # neighbors j for i to aggregate which basis
     # functions contribute the most
-    basis_aggregated = np.zeros((n_atoms, num_centers + num_bessel))
+    basis_aggregated = np.zeros((n_atoms, basis_features.shape[1]))
     np.add.at(basis_aggregated, i, basis_features)
     neighbor_counts = np.bincount(i, minlength=n_atoms)
     basis_aggregated /= neighbor_counts[:, None] + 1e-8
@@ -136,6 +172,31 @@ def create_node_features(
             basis_aggregated,
         )
     )
+    return node_features, neighbor_counts
+
+
+def create_node_features(
+    atoms, cutoff: float, num_centers: int = 8
+) -> tuple:
+    """Create node features: atomic number, mass, covalent radius, basis
+    expansion.
+
+    When we first feed inputs into the GNN, we need to create node(edge)
+    features. This is just a vector, matrix, tensor of features that is tied
+    to each node(edge) on the graph. This is what we are trying to learn,
+    that is which of these features are important on a node(edge) based on
+    the graph structure and information passed from neighboring nodes(edges).
+
+    Most of MLIPs are actually focused on the best set of node(edge) feature
+    representations. A lot is centered around basis expansions and the update
+    of the functions for the features. In this function we are just using
+    basic atom properties and expanding the pair-wise distances into sampling
+    of basis functions (radial and bessel functions).
+    """
+    i, j, d = neighbor_list("ijd", atoms, cutoff)
+    n_atoms = len(atoms)
+
+    node_features, _ = raw_node_features(atoms, i, d, cutoff, num_centers)
 
     # Normalize features
     node_features = normalize_features(node_features)
@@ -165,9 +226,17 @@ def load_and_preprocess(
     dataset_raw = load_dataset(dataset_name)
     if slice:
         dataset_raw = dataset_raw[slice]
+    return preprocess_frames(dataset_raw, cutoff)
+
+
+def preprocess_frames(frames, cutoff: float) -> list[dict]:
+    """Featurize a sequence of ASE Atoms and normalize their energies.
 
+    Same output as `load_and_preprocess`, useful for structures that do not
+    come from `load_atoms` (e.g., synthetic benchmark sets).
+    """
     energies = [
-        frame.info.get("energy", 0.0) / len(frame) for frame in dataset_raw
+        frame.info.get("energy", 0.0) / len(frame) for frame in frames
     ]
     energies = np.array(energies)
     energy_mean = energies.mean()
@@ -176,7 +245,7 @@ def load_and_preprocess(
     data_list = []
     # For each structure, create the atom (i.e., node) features
     # and adjacency matrix and normalize targets.
-    for frame, energy in zip(dataset_raw, energies):
+    for frame, energy in zip(frames, energies):
         X, A = create_node_features(frame, cutoff)
         norm_energy = (energy - energy_mean) / energy_std
         data_list.append(
@@ -192,6 +261,169 @@ def load_and_preprocess(
     return data_list
 
 
+def write_feature_shards(
+    frames, cutoff: float, directory: str, shard_size: int = 1000
+) -> dict:
+    """Featurize structures and write them to disk in shards.
+
+    `frames` can be any iterable of ASE Atoms (e.g., `ase.io.iread`), only
+    one shard of featurized structures is held in memory at a time. Each
+    shard is an `.npz` file with the stacked node features, the flattened
+    adjacency matrices, the atom counts and the raw per-atom energies.
+    The energy mean and standard deviation are accumulated on the fly
+    (Welford) and stored with the shard list in `meta.json`.
+
+    Returns the metadata dictionary.
+    """
+    os.makedirs(directory, exist_ok=True)
+    shard_files = []
+    shard = []
+    count, mean, m2 = 0, 0.0, 0.0
+
+    def flush():
+        name = f"shard_{len(shard_files):05d}.npz"
+        np.savez(
+            os.path.join(directory, name),
+            X=np.concatenate([X for X, _, _ in shard]),
+            A=np.concatenate([A.ravel() for _, A, _ in shard]),
+            n_atoms=np.array([len(X) for X, _, _ in shard]),
+            energy=np.array([e for _, _, e in shard]),
+        )
+        shard_files.append(name)
+        shard.clear()
+
+    for frame in frames:
+        X, A = create_node_features(frame, cutoff)
+        energy = frame.info.get("energy", 0.0) / len(frame)
+        count += 1
+        delta = energy - mean
+        mean += delta / count
+        m2 += delta * (energy - mean)
+        shard.append((X, A, energy))
+        if len(shard) == shard_size:
+            flush()
+    if shard:
+        flush()
+
+    meta = {
+        "cutoff": cutoff,
+        "n_structures": count,
+        "energy_mean": mean,
+        "energy_std": float(np.sqrt(m2 / max(count, 1))) + 1e-8,
+        "shards": shard_files,
+    }
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class ShardedDataset:
+    """Streaming dataset over the shards written by `write_feature_shards`.
+
+    Iterating yields the same dictionaries as `load_and_preprocess`. Shards
+    are visited in a random order each pass and read by a background thread
+    that prefetches the next shard(s) while the current one is consumed.
+    Items are shuffled within a buffer of `buffer_size` structures, so the
+    memory use is bounded by the buffer plus `prefetch + 1` shards, not by
+    the dataset size.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        buffer_size: int = 1000,
+        shuffle: bool = True,
+        prefetch: int = 1,
+    ):
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.prefetch = prefetch
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+
+    def __len__(self) -> int:
+        return self.meta["n_structures"]
+
+    def read_shard(self, name: str) -> list[dict]:
+        """Load one shard and split it back into per-structure items."""
+        with np.load(os.path.join(self.directory, name)) as shard:
+            X_all, A_all = shard["X"], shard["A"]
+            n_atoms, energies = shard["n_atoms"], shard["energy"]
+        energy_mean = self.meta["energy_mean"]
+        energy_std = self.meta["energy_std"]
+
+        # Items are copied out so a buffered item does not keep its whole shard alive
+        items = []
+        x_off, a_off = 0, 0
+        for n, energy in zip(n_atoms, energies):
+            items.append(
+                {
+                    "X": X_all[x_off : x_off + n].copy(),
+                    "A": A_all[a_off : a_off + n * n].reshape(n, n).copy(),
+                    "energy": (energy - energy_mean) / energy_std,
+                    "energy_mean": energy_mean,
+                    "energy_std": energy_std,
+                    "n_atoms": int(n),
+                }
+            )
+            x_off += n
+            a_off += n * n
+        return items
+
+    def _prefetched_shards(self):
+        """Yield shards as they are loaded by the background reader."""
+        shards = self.meta["shards"]
+        if self.shuffle:
+            shards = [shards[k] for k in np.random.permutation(len(shards))]
+        loaded = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    loaded.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def reader():
+            try:
+                for name in shards:
+                    if stop.is_set():
+                        return
+                    put(self.read_shard(name))
+            except Exception as exc:
+                put(exc)
+            put(None)
+
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            while (items := loaded.get()) is not None:
+                if isinstance(items, Exception):
+                    raise items
+                yield items
+        finally:
+            stop.set()
+            thread.join()
+
+    def __iter__(self):
+        buffer = []
+        for items in self._prefetched_shards():
+            for item in items:
+                if not self.shuffle:
+                    yield item
+                elif len(buffer) < self.buffer_size:
+                    buffer.append(item)
+                else:
+                    k = np.random.randint(len(buffer))
+                    yield buffer[k]
+                    buffer[k] = item
+        for k in np.random.permutation(len(buffer)):
+            yield buffer[k]
+
+
 def leaky_relu(x: np.ndarray, alpha: float = 0.01) -> np.ndarray:
     """Leaky ReLU activation function.
 
@@ -221,6 +453,80 @@ def gnn_forward(X: np.ndarray, A: np.ndarray, params: dict) -> float:
     return atom_energies.sum()
 
 
+def gnn_input_gradient(X: np.ndarray, A: np.ndarray, params: dict) -> tuple:
+    """Energy of the GNN and its gradient with respect to the node features.
+
+    Same forward pass as `gnn_forward`, followed by one reverse sweep that
+    only propagates to the layer inputs (no parameter gradients).
+    """
+    H = X
+    Z_vals = []
+    n_layers = sum(1 for k in params if k.startswith("W_layer"))
+
+    for i in range(n_layers):
+        Z = (A @ H) @ params[f"W_layer{i}"] + params[f"b_layer{i}"]
+        H = leaky_relu(Z)
+        Z_vals.append(Z)
+
+    energy = (H @ params["W_readout"] + params["b_readout"]).sum()
+
+    dE_dH = np.broadcast_to(params["W_readout"], H.shape)
+    for i in range(n_layers - 1, -1, -1):
+        dZ = dE_dH * np.where(Z_vals[i] > 0, 1.0, 0.01)
+        dE_dH = A.T @ (dZ @ params[f"W_layer{i}"].T)
+
+    return energy, dE_dH
+
+
+def gnn_forces(
+    atoms,
+    params: dict,
+    cutoff: float,
+    num_centers: int = 8,
+    energy_mean: float = 0.0,
+    energy_std: float = 1.0,
+) -> tuple:
+    """Total energy and analytic per-atom forces predicted by the GNN.
+
+    The reverse sweep goes from the readout through the message passing
+    layers (`gnn_input_gradient`), the feature normalization, the neighbor
+    averaging of the basis values and the basis functions down to the pair
+    distances, whose gradients are scattered onto both atoms of each pair.
+    The adjacency matrix only depends on which pairs are within the cutoff,
+    so it is constant under small displacements and does not contribute.
+
+    `energy_mean`/`energy_std` undo the per-atom energy normalization of
+    `load_and_preprocess`, so the results are in eV and eV/Angstrom.
+    """
+    i, j, d, D = neighbor_list("ijdD", atoms, cutoff)
+    n_atoms = len(atoms)
+
+    raw, neighbor_counts = raw_node_features(atoms, i, d, cutoff, num_centers)
+    X = normalize_features(raw)
+    A = create_adjacency_matrix(i, j, n_atoms)
+    pred, dE_dX = gnn_input_gradient(X, A, params)
+
+    # Only the aggregated basis columns depend on positions
+    dE_draw = normalize_features_backward(raw, dE_dX)
+    n_props = raw.shape[1] - (num_centers + NUM_BESSEL)
+    dE_dbasis = dE_draw[:, n_props:] / (neighbor_counts[:, None] + 1e-8)
+
+    _, dbasis_dd = basis_expansion(d, cutoff, num_centers, derivative=True)
+    dE_dd = np.einsum("pf,pf->p", dE_dbasis[i], dbasis_dd)
+
+    # d = |D| with D = r_j + shift - r_i
+    dE_dD = (dE_dd / np.where(d > 0, d, 1.0))[:, None] * D
+    gradient = np.zeros((n_atoms, 3))
+    for axis in range(3):
+        gradient[:, axis] = np.bincount(
+            j, weights=dE_dD[:, axis], minlength=n_atoms
+        ) - np.bincount(i, weights=dE_dD[:, axis], minlength=n_atoms)
+
+    scale = energy_std * n_atoms
+    energy = (pred * energy_std + energy_mean) * n_atoms
+    return energy, -scale * gradient
+
+
 def mse_loss(pred: float, target: float) -> float:
     """Mean Squared Error Loss"""
     diff = pred - target
@@ -347,58 +653,296 @@ def adam_update(
             params[k] -= lr * m_hat / (np.sqrt(v_hat) + eps)
 
 
+def param_layout(params: dict) -> tuple[list[tuple], int]:
+    """Layout of the parameters in one flat float64 vector.
+
+    Returns a list of (key, shape, offset, size) and the total size. The
+    flat vector is what gets shared between the training processes.
+    """
+    layout = []
+    offset = 0
+    for k, v in params.items():
+        shape = np.shape(v)
+        size = int(np.prod(shape))
+        layout.append((k, shape, offset, size))
+        offset += size
+    return layout, offset
+
+
+def batch_gradients(items: list[dict], params: dict) -> dict:
+    """Sum of the per-structure gradients and losses over `items`."""
+    total = {}
+    for item in items:
+        X, A, y = item["X"], item["A"], item["energy"]
+        y_pred = gnn_forward(X, A, params)
+        grads = gnn_backward(X, A, params, y_pred, y)
+        for k, g in grads.items():
+            total[k] = total[k] + g if k in total else np.array(g, dtype=float)
+    return total
+
+
+def _pack_shard(items: list[dict]) -> tuple:
+    """Copy the X and A matrices of a shard into one shared memory block.
+
+    Returns the block and an index of (offset, n_atoms, n_features, energy)
+    per structure so a worker can rebuild zero-copy views.
+    """
+    total = sum(item["X"].size + item["A"].size for item in items)
+    shm = shared_memory.SharedMemory(create=True, size=max(total, 1) * 8)
+    buf = np.ndarray((total,), dtype=np.float64, buffer=shm.buf)
+    index = []
+    offset = 0
+    for item in items:
+        n, f = item["X"].shape
+        buf[offset : offset + n * f] = item["X"].ravel()
+        buf[offset + n * f : offset + n * f + n * n] = item["A"].ravel()
+        index.append((offset, n, f, item["energy"]))
+        offset += n * f + n * n
+    return shm, index
+
+
+def _gradient_worker(
+    rank, conn, shard_name, shard_index, param_name, grad_name, layout, n_params,
+    n_workers,
+):
+    """Worker loop: compute gradient sums for the requested shard entries.
+
+    Parameters are read from the shared flat vector that the main process
+    updates after every ADAM step, the summed gradient (loss in the last
+    slot) is written to this worker's row of the shared gradient buffer.
+    """
+    shard_shm = shared_memory.SharedMemory(name=shard_name)
+    param_shm = shared_memory.SharedMemory(name=param_name)
+    grad_shm = shared_memory.SharedMemory(name=grad_name)
+    buf = np.ndarray(
+        (shard_shm.size // 8,), dtype=np.float64, buffer=shard_shm.buf
+    )
+    flat = np.ndarray((n_params,), dtype=np.float64, buffer=param_shm.buf)
+    grad_out = np.ndarray(
+        (n_workers, n_params + 1), dtype=np.float64, buffer=grad_shm.buf
+    )
+    params = {k: flat[o : o + s].reshape(shape) for k, shape, o, s in layout}
+
+    items = []
+    for offset, n, f, energy in shard_index:
+        X = buf[offset : offset + n * f].reshape(n, f)
+        A = buf[offset + n * f : offset + n * f + n * n].reshape(n, n)
+        items.append({"X": X, "A": A, "energy": energy})
+
+    while True:
+        local = conn.recv()
+        if local is None:
+            break
+        g = np.zeros(n_params + 1)
+        if len(local):
+            grads = batch_gradients([items[li] for li in local], params)
+            for k, shape, o, s in layout:
+                g[o : o + s] = np.ravel(grads[k])
+            g[-1] = grads["loss"]
+        grad_out[rank] = g
+        conn.send(True)
+
+    del buf, flat, grad_out, params, items
+    shard_shm.close()
+    param_shm.close()
+    grad_shm.close()
+
+
+class ShardedGradients:
+    """Data-parallel gradient evaluation over worker processes.
+
+    The featurized dataset is split into `n_workers` contiguous shards, each
+    packed into its own shared memory block and owned by one worker. For a
+    mini-batch the main process broadcasts the parameters through a shared
+    flat vector, every worker sums the gradients of the batch members it
+    owns, and the partial sums are reduced in the main process.
+    """
+
+    def __init__(self, data_list: list[dict], params: dict, n_workers: int):
+        self.layout, self.n_params = param_layout(params)
+        self.n_workers = n_workers
+        shards = np.array_split(np.arange(len(data_list)), n_workers)
+        self.owner = np.empty(len(data_list), dtype=int)
+        self.local = np.empty(len(data_list), dtype=int)
+        for rank, shard in enumerate(shards):
+            self.owner[shard] = rank
+            self.local[shard] = np.arange(len(shard))
+
+        self.param_shm = shared_memory.SharedMemory(
+            create=True, size=self.n_params * 8
+        )
+        self.grad_shm = shared_memory.SharedMemory(
+            create=True, size=n_workers * (self.n_params + 1) * 8
+        )
+        self.flat = np.ndarray(
+            (self.n_params,), dtype=np.float64, buffer=self.param_shm.buf
+        )
+        self.grad_out = np.ndarray(
+            (n_workers, self.n_params + 1),
+            dtype=np.float64,
+            buffer=self.grad_shm.buf,
+        )
+
+        self.shard_shms = []
+        self.conns = []
+        self.procs = []
+        ctx = mp.get_context()
+        for rank, shard in enumerate(shards):
+            shm, index = _pack_shard([data_list[k] for k in shard])
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(
+                target=_gradient_worker,
+                args=(
+                    rank, child, shm.name, index, self.param_shm.name,
+                    self.grad_shm.name, self.layout, self.n_params, n_workers,
+                ),
+                daemon=True,
+            )
+            proc.start()
+            self.shard_shms.append(shm)
+            self.conns.append(parent)
+            self.procs.append(proc)
+
+    def broadcast(self, params: dict):
+        """Copy the current parameters into the shared flat vector."""
+        for k, shape, o, s in self.layout:
+            self.flat[o : o + s] = np.ravel(params[k])
+
+    def gradients(self, params: dict, batch: np.ndarray) -> dict:
+        """Summed gradients and loss over the structures in `batch`."""
+        self.broadcast(params)
+        for rank, conn in enumerate(self.conns):
+            conn.send(self.local[batch[self.owner[batch] == rank]])
+        for conn in self.conns:
+            conn.recv()
+        g = self.grad_out.sum(axis=0)
+        grads = {
+            k: g[o : o + s].reshape(shape).copy()
+            for k, shape, o, s in self.layout
+        }
+        grads["loss"] = g[-1]
+        return grads
+
+    def close(self):
+        """Stop the workers and release the shared memory blocks."""
+        for conn in self.conns:
+            conn.send(None)
+        for proc in self.procs:
+            proc.join()
+        del self.flat, self.grad_out
+        for shm in [self.param_shm, self.grad_shm, *self.shard_shms]:
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _stream_batches(dataset, batch_size: int):
+    """Group the items of an iterable dataset into lists of `batch_size`."""
+    batch = []
+    for item in dataset:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def train_gnn(
-    data_list: list[dict],
+    data_list: list[dict] | ShardedDataset,
     params: dict,
     epochs: int = 10,
     initial_lr: float = 1e-5,
     l2_lambda: float = 1e-4,
     clip_value: float = 1.0,
     decay_rate: float = 0.98,
-):
+    batch_size: int = 1,
+    n_workers: int = 1,
+    loss_plot: str | None = "plots/loss.png",
+) -> list[float]:
     """Train a GNN using ADAM optimizer with:
     1. Learning rate decay - prevents overfitting, allows for fine-tuning
     2. L2 regularization - prevents overfitting, penalizes large weights
     3. Gradient clipping - prevents exploding gradients, stabilizes training
 
+    Gradients are averaged over mini-batches of `batch_size` structures
+    (the default of 1 is plain per-structure updates). With `n_workers > 1`
+    the batch gradients are computed data-parallel by `ShardedGradients`,
+    the batches and updates are identical to the single-process run so the
+    results agree up to floating point summation order.
+
+    `data_list` can also be a `ShardedDataset`, in which case batches are
+    taken from the stream as it is read (single process only).
+
+    Returns the average loss per epoch.
     """
+    streaming = not isinstance(data_list, list)
+    if streaming and n_workers > 1:
+        raise ValueError("Data-parallel training needs an in-memory data list.")
     adam_state = init_adam_state(params)
-    plt.figure()
+    if loss_plot:
+        plt.figure()
     losses = []
-
-    for epoch in range(epochs):
-        np.random.shuffle(data_list)
-        epoch_loss = 0.0
-
-        # 1. Learning rate decay
-        lr = initial_lr * (decay_rate**epoch)
-
-        for item in data_list:
-            X, A, y = item["X"], item["A"], item["energy"]
-            y_pred = gnn_forward(X, A, params)
-            grads = gnn_backward(X, A, params, y_pred, y)
-
-            # 2. L2 regularization
-            for k in params:
-                if "W" in k:
-                    grads[k] += l2_lambda * params[k]
-
-            # 3. Gradient clipping
-            for k in grads:
-                grads[k] = np.clip(np.array(grads[k]), -clip_value, clip_value)
-
-            adam_update(params, grads, adam_state, lr)
-            epoch_loss += grads["loss"]
-
-        avg_loss = epoch_loss / len(data_list)
-        losses.append(avg_loss)
-
-        plt.clf()
-        plt.plot(losses)
-        plt.yscale("log")
-        plt.savefig("plots/loss.png")
-
-        print(f"Epoch {epoch+1}/{epochs}, Loss={avg_loss:.6f}, LR={lr:.2e}")
+    pool = ShardedGradients(data_list, params, n_workers) if n_workers > 1 else None
+
+    try:
+        for epoch in range(epochs):
+            if streaming:
+                batches = _stream_batches(data_list, batch_size)
+            else:
+                order = np.random.permutation(len(data_list))
+                batches = (
+                    order[start : start + batch_size]
+                    for start in range(0, len(order), batch_size)
+                )
+            epoch_loss = 0.0
+            n_seen = 0
+
+            # 1. Learning rate decay
+            lr = initial_lr * (decay_rate**epoch)
+
+            for batch in batches:
+                if pool is not None:
+                    grads = pool.gradients(params, batch)
+                else:
+                    items = batch if streaming else [data_list[k] for k in batch]
+                    grads = batch_gradients(items, params)
+                for k in grads:
+                    grads[k] = grads[k] / len(batch)
+
+                # 2. L2 regularization
+                for k in params:
+                    if "W" in k:
+                        grads[k] += l2_lambda * params[k]
+
+                # 3. Gradient clipping
+                for k in grads:
+                    grads[k] = np.clip(np.array(grads[k]), -clip_value, clip_value)
+
+                adam_update(params, grads, adam_state, lr)
+                epoch_loss += grads["loss"] * len(batch)
+                n_seen += len(batch)
+
+            avg_loss = epoch_loss / n_seen
+            losses.append(avg_loss)
+
+            if loss_plot:
+                plt.clf()
+                plt.plot(losses)
+                plt.yscale("log")
+                plt.savefig(loss_plot)
+
+            print(f"Epoch {epoch+1}/{epochs}, Loss={avg_loss:.6f}, LR={lr:.2e}")
+    finally:
+        if pool is not None:
+            pool.close()
+
+    return losses
 
 
 def evaluate_model(data_list: list[dict], params: dict) -> tuple:
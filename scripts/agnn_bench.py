@@ -0,0 +1,393 @@
+# /// script
+# requires-python = ">=3.10"
+# dependencies = [
+#     "numpy",
+#     "load-atoms",
+#     "matplotlib",
+#     "ase",
+#     "mendeleev",
+# ]
+# author = "Stefan Bringuier <stefan.bringuier@gmail.com>"
+# description = "Benchmarks for the numpy Atomic Graph Neural Network in agnn.py"
+# license = "MIT"
+# ///
+"""Benchmarks for `agnn.py` on synthetic structures.
+
+Run from the `scripts` directory, e.g.:
+
+    python agnn_bench.py parallel --workers 1 2 4 8 16
+    python agnn_bench.py forces --atoms 10 50 100
+    python agnn_bench.py engine --save-baseline agnn_baseline.json
+    python agnn_bench.py engine --baseline agnn_baseline.json
+"""
+
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+from ase.build import bulk
+from ase import Atoms
+from ase.neighborlist import neighbor_list
+
+import agnn
+
+
+def synthetic_energy(atoms, cutoff: float = 3.0) -> float:
+    """Cheap Morse-like pair energy so targets depend on the geometry."""
+    d = neighbor_list("d", atoms, cutoff)
+    return 0.5 * np.sum(np.exp(-2.0 * (d - 1.5)) - 2.0 * np.exp(-(d - 1.5)))
+
+
+def molecular_structure(n_atoms: int, rng, spacing: float = 1.4) -> Atoms:
+    """Random non-periodic C/H/N/O cluster.
+
+    Atoms sit on a jittered cubic grid so no pair is closer than
+    `spacing - 0.4` Angstrom.
+    """
+    side = int(np.ceil(n_atoms ** (1.0 / 3.0)))
+    grid = np.indices((side, side, side)).reshape(3, -1).T[:n_atoms]
+    positions = spacing * grid + rng.uniform(-0.2, 0.2, (n_atoms, 3))
+    numbers = rng.choice([1, 6, 7, 8], n_atoms)
+    atoms = Atoms(numbers=numbers, positions=positions)
+    atoms.info["energy"] = synthetic_energy(atoms)
+    return atoms
+
+
+def periodic_structure(n_atoms: int, rng, rattle: float = 0.05) -> Atoms:
+    """Rattled NiTi B2 supercell with at least `n_atoms` atoms."""
+    reps = max(1, int(np.ceil((n_atoms / 2) ** (1.0 / 3.0))))
+    atoms = bulk("NiTi", "cesiumchloride", a=3.0) * (reps, reps, reps)
+    atoms.positions += rng.normal(0.0, rattle, atoms.positions.shape)
+    atoms.info["energy"] = synthetic_energy(atoms)
+    return atoms
+
+
+def synthetic_dataset(
+    n_structures: int, n_atoms: int, kind: str = "molecular", seed: int = 0
+) -> list:
+    """List of synthetic ASE structures of (about) `n_atoms` atoms."""
+    rng = np.random.default_rng(seed)
+    build = molecular_structure if kind == "molecular" else periodic_structure
+    return [build(n_atoms, rng) for _ in range(n_structures)]
+
+
+DEFAULT_CUTOFF = {"molecular": 2.25, "periodic": 3.0}
+
+
+def resolve_cutoff(cutoff, kind: str) -> float:
+    """`--cutoff` if given, else a cutoff that reaches the nearest neighbors
+    of `kind` (2.6 Angstrom in the a=3.0 B2 cell, above the molecular 2.25)."""
+    return DEFAULT_CUTOFF[kind] if cutoff is None else cutoff
+
+
+def check_graph(frames: list, cutoff: float):
+    """Stop if a structure has no pairs within `cutoff`, which would
+    benchmark an empty graph."""
+    for atoms in frames:
+        if len(neighbor_list("i", atoms, cutoff)) == 0:
+            raise SystemExit(
+                f"No neighbors within cutoff {cutoff} in a {len(atoms)}-atom "
+                "structure; increase --cutoff."
+            )
+
+
+def bench_parallel(args):
+    """Epoch time of `train_gnn` vs. number of worker processes.
+
+    Also reports the largest parameter deviation from the single-process
+    run, which should be at floating point summation noise.
+    """
+    frames = synthetic_dataset(args.structures, args.atoms, args.kind)
+    cutoff = resolve_cutoff(args.cutoff, args.kind)
+    check_graph(frames, cutoff)
+    data_list = agnn.preprocess_frames(frames, cutoff=cutoff)
+    feature_dim = data_list[0]["X"].shape[1]
+
+    reference = None
+    base_time = None
+    print(f"{'workers':>8} {'s/epoch':>10} {'speedup':>8} {'max |dp|':>10}")
+    for n_workers in args.workers:
+        params = agnn.init_params(feature_dim, [32, 32, 32])
+        np.random.seed(args.seed)
+        start = time.perf_counter()
+        agnn.train_gnn(
+            data_list,
+            params,
+            epochs=args.epochs,
+            initial_lr=9e-4,
+            batch_size=args.batch_size,
+            n_workers=n_workers,
+            loss_plot=None,
+        )
+        elapsed = (time.perf_counter() - start) / args.epochs
+        if reference is None:
+            reference, base_time = params, elapsed
+        deviation = max(
+            np.max(np.abs(np.asarray(params[k]) - np.asarray(reference[k])))
+            for k in params
+        )
+        print(
+            f"{n_workers:>8d} {elapsed:>10.4f} "
+            f"{base_time / elapsed:>8.2f} {deviation:>10.2e}"
+        )
+        if deviation > args.atol:
+            print(f"WARNING: deviation above tolerance {args.atol:.1e}")
+
+
+def force_check_params(feature_dim: int, hidden_dims: list[int]) -> dict:
+    """`init_params` rescaled to unit-order weights.
+
+    The initial weights are so small that forces are ~1e-9, below anything
+    a finite-difference comparison could tell apart from zero.
+    """
+    params = agnn.init_params(feature_dim, hidden_dims)
+    for k in params:
+        if k.startswith("W_layer"):
+            params[k] *= 100.0
+    params["W_readout"] *= 1e4
+    return params
+
+
+def bench_forces(args):
+    """Analytic `gnn_forces` vs. central finite differences.
+
+    Reports the time of both and the largest force component deviation.
+    """
+    h = args.step
+    print(
+        f"{'atoms':>8} {'analytic s':>11} {'fd s':>10} "
+        f"{'max |F|':>10} {'max |dF|':>10}"
+    )
+    cutoff = resolve_cutoff(args.cutoff, args.kind)
+    for n_atoms in args.atoms:
+        atoms = synthetic_dataset(1, n_atoms, args.kind)[0]
+        check_graph([atoms], cutoff)
+        X, _ = agnn.create_node_features(atoms, cutoff)
+        params = force_check_params(X.shape[1], [32, 32, 32])
+
+        start = time.perf_counter()
+        _, forces = agnn.gnn_forces(atoms, params, cutoff)
+        analytic = time.perf_counter() - start
+
+        start = time.perf_counter()
+        fd = np.zeros_like(forces)
+        for a in range(len(atoms)):
+            for c in range(3):
+                shifted = atoms.copy()
+                shifted.positions[a, c] += h
+                X, A = agnn.create_node_features(shifted, cutoff)
+                e_plus = agnn.gnn_forward(X, A, params)
+                shifted.positions[a, c] -= 2 * h
+                X, A = agnn.create_node_features(shifted, cutoff)
+                e_minus = agnn.gnn_forward(X, A, params)
+                fd[a, c] = -(e_plus - e_minus) / (2 * h) * len(atoms)
+        numeric = time.perf_counter() - start
+
+        print(
+            f"{len(atoms):>8d} {analytic:>11.4f} {numeric:>10.4f} "
+            f"{np.max(np.abs(forces)):>10.2e} {np.max(np.abs(forces - fd)):>10.2e}"
+        )
+
+
+ENGINE_STAGES = (
+    "create_node_features",
+    "create_adjacency_matrix",
+    "gnn_forward",
+    "gnn_backward",
+    "adam_update",
+)
+
+
+def time_stage(func, repeats: int) -> tuple[float, float]:
+    """Best wall time (s) over `repeats` calls and peak traced memory (MB).
+
+    The memory is measured on a separate first call with tracemalloc, which
+    tracks numpy allocations, so the timings are not slowed by tracing.
+    """
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best, peak / 2**20
+
+
+def engine_stages(atoms, cutoff: float, hidden_dims: list[int]) -> dict:
+    """Callables for each engine stage on one structure."""
+    i, j, _ = neighbor_list("ijd", atoms, cutoff)
+    if len(i) == 0:
+        raise SystemExit(f"No neighbors within cutoff {cutoff}; increase --cutoff.")
+    n_atoms = len(atoms)
+    X, A = agnn.create_node_features(atoms, cutoff)
+    params = agnn.init_params(X.shape[1], hidden_dims)
+    state = agnn.init_adam_state(params)
+    pred = agnn.gnn_forward(X, A, params)
+    grads = agnn.gnn_backward(X, A, params, pred, 0.0)
+    return {
+        "create_node_features": lambda: agnn.create_node_features(atoms, cutoff),
+        "create_adjacency_matrix": lambda: agnn.create_adjacency_matrix(
+            i, j, n_atoms
+        ),
+        "gnn_forward": lambda: agnn.gnn_forward(X, A, params),
+        "gnn_backward": lambda: agnn.gnn_backward(X, A, params, pred, 0.0),
+        "adam_update": lambda: agnn.adam_update(params, grads, state, 1e-5),
+    }
+
+
+def scaling_exponent(sizes: list[int], times: list[float]) -> float:
+    """Least-squares slope of log(time) vs. log(atoms)."""
+    if len(sizes) < 2:
+        return float("nan")
+    return float(np.polyfit(np.log(sizes), np.log(times), 1)[0])
+
+
+def compare_baseline(results: dict, baseline: dict, tolerance: float) -> int:
+    """Print stages that got slower than the baseline by more than
+    `tolerance` (relative). Returns the number of regressions."""
+    regressions = 0
+    for kind, stages in results.items():
+        for stage, by_size in stages.items():
+            old_sizes = baseline.get(kind, {}).get(stage, {})
+            for size, entry in by_size.items():
+                if size not in old_sizes:
+                    continue
+                ratio = entry["time"] / old_sizes[size]["time"]
+                if ratio > 1.0 + tolerance:
+                    regressions += 1
+                    print(
+                        f"REGRESSION {kind:>9} {stage:<24} {size:>6} atoms: "
+                        f"{ratio:.2f}x baseline"
+                    )
+    if not regressions:
+        print(f"No regressions beyond {tolerance:.0%} of the baseline.")
+    return regressions
+
+
+def plot_scaling(results: dict, filename: str):
+    """Log-log scaling curves, one panel per structure kind."""
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(1, len(results), figsize=(6 * len(results), 4))
+    for ax, (kind, stages) in zip(np.atleast_1d(axes), results.items()):
+        for stage, by_size in stages.items():
+            sizes = [int(n) for n in by_size]
+            ax.loglog(sizes, [e["time"] for e in by_size.values()], "o-",
+                      label=stage)
+        ax.set_xlabel("Atoms")
+        ax.set_ylabel("Time (s)")
+        ax.set_title(kind)
+        ax.legend(fontsize=8)
+    fig.tight_layout()
+    fig.savefig(filename)
+    plt.close(fig)
+
+
+def bench_engine(args):
+    """Per-stage time, scaling and peak memory of the agnn engine."""
+    results = {}
+    for kind in args.kinds:
+        results[kind] = {stage: {} for stage in ENGINE_STAGES}
+        for n_atoms in args.atoms:
+            atoms = synthetic_dataset(1, n_atoms, kind)[0]
+            stages = engine_stages(atoms, resolve_cutoff(args.cutoff, kind), args.hidden)
+            for stage in ENGINE_STAGES:
+                best, peak = time_stage(stages[stage], args.repeats)
+                results[kind][stage][str(len(atoms))] = {
+                    "time": best,
+                    "peak_mb": peak,
+                }
+                print(
+                    f"{kind:>9} {stage:<24} {len(atoms):>6d} atoms "
+                    f"{best:>10.3e} s {peak:>9.2f} MB"
+                )
+
+    print(f"\n{'kind':>9} {'stage':<24} {'exponent':>8}")
+    for kind, stages in results.items():
+        for stage, by_size in stages.items():
+            sizes = [int(n) for n in by_size]
+            times = [entry["time"] for entry in by_size.values()]
+            print(f"{kind:>9} {stage:<24} {scaling_exponent(sizes, times):>8.2f}")
+
+    if args.plot:
+        plot_scaling(results, args.plot)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cutoff": {kind: resolve_cutoff(args.cutoff, kind) for kind in args.kinds},
+            "hidden": args.hidden,
+        },
+        "results": results,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if compare_baseline(results, baseline, args.tolerance):
+            raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    par = sub.add_parser("parallel", help="Data-parallel training scaling")
+    par.add_argument("--workers", type=int, nargs="+",
+                     default=[1, 2, 4, 8, 16])
+    par.add_argument("--structures", type=int, default=256)
+    par.add_argument("--atoms", type=int, default=20)
+    par.add_argument("--kind", choices=["molecular", "periodic"],
+                     default="molecular")
+    par.add_argument("--batch-size", type=int, default=64)
+    par.add_argument("--epochs", type=int, default=3)
+    par.add_argument("--cutoff", type=float, default=None,
+                     help="Neighbor cutoff (default: 2.25 molecular, 3.0 periodic)")
+    par.add_argument("--seed", type=int, default=42)
+    par.add_argument("--atol", type=float, default=1e-6)
+    par.set_defaults(func=bench_parallel)
+
+    frc = sub.add_parser("forces", help="Analytic vs. finite-difference forces")
+    frc.add_argument("--atoms", type=int, nargs="+", default=[10, 50, 100])
+    frc.add_argument("--kind", choices=["molecular", "periodic"],
+                     default="molecular")
+    frc.add_argument("--cutoff", type=float, default=None,
+                     help="Neighbor cutoff (default: 2.25 molecular, 3.0 periodic)")
+    frc.add_argument("--step", type=float, default=1e-5)
+    frc.set_defaults(func=bench_forces)
+
+    eng = sub.add_parser("engine", help="Per-stage engine throughput")
+    eng.add_argument("--atoms", type=int, nargs="+",
+                     default=[10, 100, 1000, 10000])
+    eng.add_argument("--kinds", nargs="+", choices=["molecular", "periodic"],
+                     default=["molecular", "periodic"])
+    eng.add_argument("--cutoff", type=float, default=None,
+                     help="Neighbor cutoff (default: 2.25 molecular, 3.0 periodic)")
+    eng.add_argument("--hidden", type=int, nargs="+", default=[32, 32, 32])
+    eng.add_argument("--repeats", type=int, default=3)
+    eng.add_argument("--plot", help="Save log-log scaling curves to file")
+    eng.add_argument("--save-baseline", help="Write results to a JSON file")
+    eng.add_argument("--baseline", help="Compare against a baseline JSON")
+    eng.add_argument("--tolerance", type=float, default=0.25,
+                     help="Allowed relative slowdown vs. the baseline")
+    eng.set_defaults(func=bench_engine)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
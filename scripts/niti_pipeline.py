@@ -0,0 +1,218 @@
+import argparse
+import json
+import os
+import numpy as np
+from ase import Atoms
+from ase.io import read, write
+
+from orderparam import NiTiSystem, OrderParameterStatistics
+from vasp_velocities import H5MDWriter, frame_numbers, iter_frames, parse_frames, stream_velocities
+
+__author__ = "Stefan Bringuier"
+__email__ = "stefanbringuier@gmail.com"
+__version__ = "0.1"
+__description__ = """Velocities and NiTi order parameter from one pass over an XDATCAR or vasprun.xml AIMD
+                     trajectory, written together to one H5MD or extxyz file.
+                  """
+
+
+def iter_pipeline(input, frames=slice(None), timestep=0.001, params=None, skin=1.1, domains=None):
+    '''
+        Read each selected frame once and compute its finite-difference
+        velocities (see vasp_velocities.stream_velocities) and per-atom order
+        parameter (see NiTiSystem.calculate_order_parameter) together. With
+        domains set, the martensite domains (op > domains) are labeled from
+        the same neighbor pairs (see NiTiSystem.label_domains). Frames are
+        numbered by their place in the whole trajectory.
+
+    - input: str - vasprun.xml or XDATCAR
+    - frames: slice - frames to use
+    - timestep: float - time in picoseconds between XDATCAR frames
+    - params: dict - order parameter parameters, default NiTiSystem.default_params
+    - skin: float - neighbor list skin
+    - domains: float - order parameter threshold of the domain analysis
+    - returns: (list(str), float, generator) - species, time between frames,
+               (frame number, positions, velocities, cell, op, domain statistics
+               or None) per frame
+    '''
+    params = {**NiTiSystem.default_params, **(params or {})}
+    species, dt, steps = iter_frames(input, frames, timestep)
+    numbers = frame_numbers(input, frames)
+
+    def frames_of(steps):
+        for frame, (positions, velocities, cell) in zip(numbers, stream_velocities(steps, dt)):
+            atoms = Atoms(symbols=species, positions=positions, cell=cell, pbc=True)
+            if not NiTiSystem.is_niti(atoms):
+                yield frame, positions, velocities, cell, np.full(len(species), np.nan), None
+                continue
+            pairs = NiTiSystem.neighbor_pairs(atoms, skin)
+            op = NiTiSystem.order_parameter_from_shells(*NiTiSystem.shell_averages(atoms, *pairs), params)
+            stats = None
+            if domains is not None:
+                labels = NiTiSystem.label_domains(op, pairs, domains)
+                stats = NiTiSystem.domain_statistics(atoms, labels)
+            yield frame, positions, velocities, cell, op, stats
+    return species, dt, frames_of(steps)
+
+def run_pipeline(input, output, frames=slice(None), timestep=0.001, params=None, skin=1.1,
+                 append=False, chunk_frames=64, domains=None, domains_output=None,
+                 statistics=None, statistics_output=None):
+    '''
+        Stream a trajectory through iter_pipeline() into output: H5MD for
+        .h5/.h5md (positions, velocities, box and op, written chunk_frames
+        frames at a time), extxyz with velocities and an op column otherwise.
+        Domain statistics are written to domains_output as one JSON line per
+        frame. With statistics (an OrderParameterStatistics) each frame's op
+        is also reduced into it and the time series written to
+        statistics_output; output may then be None to keep no per-atom data.
+        All outputs share the frame numbers and times of iter_pipeline(); with
+        append, frames numbered at or before the last frame already in the
+        outputs are shifted to follow it.
+
+    - returns: int - frames processed
+    '''
+    stride = abs(frames.step or 1)
+    species, dt, results = iter_pipeline(input, frames, timestep, params, skin, domains)
+    frame_time = dt / stride  # Time between consecutive trajectory frames
+    if append:
+        last = _last_frame(output, domains_output, statistics_output, frame_time)
+        if last is not None:
+            results = _continue(results, last + stride)
+    if domains_output is not None:
+        results = _write_domains(results, domains_output, append)
+    if statistics is not None:
+        results = _reduce(results, statistics, frame_time)
+    nframes = 0
+    if output is None:
+        for _ in results:
+            nframes += 1
+    elif output.endswith(('.h5', '.h5md')):
+        with H5MDWriter(output, species, append=append, chunk_frames=chunk_frames) as writer:
+            block = []
+            for result in results:
+                block.append(result)
+                if len(block) == chunk_frames:
+                    nframes += _flush(writer, block, frame_time)
+            nframes += _flush(writer, block, frame_time)
+    else:
+        with open(output, 'a' if append else 'w') as f:
+            for frame, positions, velocities, cell, op, _ in results:
+                atoms = Atoms(symbols=species, positions=positions, cell=cell, pbc=True,
+                              info={'frame': frame, 'time': frame * frame_time})
+                atoms.set_velocities(velocities)
+                atoms.set_array('op', op)
+                write(f, atoms, format='extxyz')
+                nframes += 1
+    if statistics is not None and statistics_output is not None:
+        statistics.write(statistics_output, append=append)
+    return nframes
+
+def _flush(writer, block, frame_time):
+    # Append a block of iter_pipeline() results, at their frame numbers, and empty it
+    if not block:
+        return 0
+    frames, positions, velocities, cells, op, _ = (np.array(column) for column in zip(*block))
+    writer.append(positions, velocities, cells, frame_time, step=frames, op=op)
+    n = len(block)
+    block.clear()
+    return n
+
+def _last_frame(output, domains_output=None, statistics_output=None, frame_time=None):
+    # Number of the last frame already in the outputs, None if they hold none:
+    # the H5MD step, extxyz frame info, domain record frame or statistics time
+    last = []
+    if output is not None and os.path.exists(output):
+        if output.endswith(('.h5', '.h5md')):
+            import h5py
+            with h5py.File(output, 'r') as f:
+                if 'particles/all/position/step' in f and len(f['particles/all/position/step']):
+                    last.append(int(f['particles/all/position/step'][-1]))
+        elif os.path.getsize(output):
+            last.append(read(output, index=-1, format='extxyz').info.get('frame'))
+    if domains_output is not None and os.path.exists(domains_output):
+        with open(domains_output) as f:
+            records = [line for line in f if line.strip()]
+        if records:
+            last.append(json.loads(records[-1])['frame'])
+    if statistics_output is not None and os.path.exists(statistics_output):
+        if statistics_output.endswith('.npz'):
+            with np.load(statistics_output) as f:
+                times = f['series'][:, 0]
+        else:
+            times = np.loadtxt(statistics_output, ndmin=2)[:, 0]
+        if len(times):
+            last.append(int(round(times[-1] / frame_time)))
+    last = [int(n) for n in last if n is not None]
+    return max(last) if last else None
+
+def _continue(results, first):
+    # Pass iter_pipeline() results through, shifting their frame numbers to
+    # start at first or later (e.g. the next segment of a trajectory appended
+    # to the output of the previous one, which restarts at frame 0)
+    shift = None
+    for result in results:
+        if shift is None:
+            shift = max(0, first - result[0])
+        yield (result[0] + shift,) + result[1:]
+
+def _write_domains(results, filename, append=False):
+    # Pass iter_pipeline() results through, writing each frame's domain statistics
+    with open(filename, 'a' if append else 'w') as f:
+        for result in results:
+            frame, stats = result[0], result[-1]
+            if stats is not None:
+                record = {"frame": frame, "count": stats["count"], "sizes": stats["sizes"].tolist(),
+                          "centroids": np.round(stats["centroids"], 4).tolist()}
+                f.write(json.dumps(record) + "\n")
+            yield result
+
+def _reduce(results, statistics, frame_time):
+    # Pass iter_pipeline() results through, reducing each frame's op at its time
+    for result in results:
+        statistics.update(result[4], result[0] * frame_time)
+        yield result
+
+def parse_param(text):
+    # NAME=VALUE order parameter override, e.g. d0B19=2.55
+    name, value = text.split('=')
+    if name not in NiTiSystem.default_params:
+        raise argparse.ArgumentTypeError(f"Unknown parameter '{name}', one of {list(NiTiSystem.default_params)}")
+    return name, float(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__description__)
+    parser.add_argument('input', help='Input file (vasprun.xml or XDATCAR)')
+    parser.add_argument('output', nargs='?',
+                        help='Output file (output.h5md or output.extxyz), omit to only write --stats/--domains')
+    parser.add_argument('--timestep', type=float, default=0.001,
+                        help='Timestep in picoseconds between XDATCAR frames (POTIM*NBLOCK/1000)')
+    parser.add_argument('--frames', type=parse_frames, default=slice(None),
+                        help='Frames to use as START:STOP[:STEP] (default: all)')
+    parser.add_argument('--param', type=parse_param, action='append', default=[],
+                        help='Order parameter override NAME=VALUE (d0B19, d1B19, d0B2, d1B2)')
+    parser.add_argument('--skin', type=float, default=1.1, help='Neighbor list skin for the order parameter')
+    parser.add_argument('--append', action='store_true', help='Append the frames to an existing output')
+    parser.add_argument('--domains', help='Write martensite domain counts, sizes and centroids per frame '
+                                          'to this file (JSON lines)')
+    parser.add_argument('--threshold', type=float, default=0.0,
+                        help='Order parameter above which an atom is martensite (B2 is -1, B19 +1)')
+    parser.add_argument('--stats', help='Write the per-frame op mean, variance, range, fractions above '
+                                        '--fractions and (.npz) histograms to this file')
+    parser.add_argument('--fractions', type=float, nargs='+', default=[0.0],
+                        help='Order parameter thresholds to report the fraction of atoms above')
+    parser.add_argument('--bins', type=int, default=40, help='Histogram bins over op in [-2, 2]')
+
+    args = parser.parse_args()
+    if args.output is None and args.stats is None and args.domains is None:
+        parser.error('nothing to write: give an output file, --stats or --domains')
+    statistics = None
+    if args.stats:
+        statistics = OrderParameterStatistics(args.fractions, np.linspace(-2.0, 2.0, args.bins + 1))
+    n = run_pipeline(args.input, args.output, args.frames, args.timestep, dict(args.param), args.skin, args.append,
+                     domains=args.threshold if args.domains else None, domains_output=args.domains,
+                     statistics=statistics, statistics_output=args.stats)
+    print(f"Processed {n} frames")
+    if statistics is not None:
+        summary = statistics.summary()
+        print(f"op over all frames: mean {summary['mean']:.4f}, variance {summary['variance']:.4f}")
@@ -1,7 +1,11 @@
+import os
 from ase import Atoms
-from ase.neighborlist import NeighborList, natural_cutoffs
+from ase.neighborlist import natural_cutoffs, neighbor_list
 from ase.build import bulk
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.spatial import cKDTree
+from scipy.sparse.csgraph import connected_components
 
 
 class NiTiSystem(Atoms):
@@ -67,6 +71,9 @@ class NiTiSystem(Atoms):
     def get_order_parameter(self, params=None, skin=None):
         """
         Interface method to get the order parameter.
+
+        The neighbor shell averages d0 and d1 are cached, so calls that only
+        change params reuse them and cost one vectorized evaluation.
         """
         if params is not None:
             self.params = {**self.default_params, **params}
@@ -80,57 +87,190 @@ class NiTiSystem(Atoms):
         Instance method to calculate the order parameter using
         instance-specific parameters.
         """
-        op = self.calculate_order_parameter(self, self.params, self.skin)
+        if not self.is_niti(self):
+            op = None
+        else:
+            shells = self.get_shells()
+            op = self.order_parameter_from_shells(shells["d0"], shells["d1"], self.params)
         self.set_array("op", op)
 
+    def get_shells(self):
+        """
+        Neighbor pairs and per-atom shell averages d0/d1, cached on the
+        instance and only recomputed when the positions, cell, species or
+        skin changed since the last call.
+
+        Returns:
+            dict: "pairs" (i, j, d) arrays and "d0", "d1" per atom
+        """
+        key = (self.skin, self.numbers.tobytes(), self.cell.array.tobytes())
+        cache = getattr(self, "_shell_cache", None)
+        if (
+            cache is None
+            or cache["key"] != key
+            or not np.array_equal(cache["positions"], self.positions)
+        ):
+            pairs = self.neighbor_pairs(self, self.skin)
+            d0, d1 = self.shell_averages(self, *pairs)
+            cache = {
+                "key": key,
+                "positions": self.positions.copy(),
+                "pairs": pairs,
+                "d0": d0,
+                "d1": d1,
+            }
+            self._shell_cache = cache
+        return cache
+
     @staticmethod
-    def calculate_order_parameter(atoms, params, skin=1.1):
+    def is_niti(atoms):
+        return all(symbol in atoms.get_chemical_symbols() for symbol in ["Ni", "Ti"])
+
+    @staticmethod
+    def neighbor_pairs(atoms, skin=1.1):
         """
-        Static method to calculate the order parameter for a given Atoms object.
+        Neighbor pairs (i, j) and distances d, both ways and without self
+        interaction, within the natural cutoffs scaled by skin (plus the
+        0.3 Angstrom per-atom skin of ASE's NeighborList).
+
+        Periodic orthorhombic cells more than twice the cutoff wide use a
+        periodic KD-tree, which needs far less memory than ASE's
+        neighbor_list on multi-million-atom cells.
         """
-        if not all(symbol in atoms.get_chemical_symbols() for symbol in ["Ni", "Ti"]):
-            print("Skipping order parameter calculation: Not a NiTi system.")
-            return None
+        cutoffs = np.asarray(natural_cutoffs(atoms, mult=skin)) + 0.3
+        cell = atoms.cell.array
+        lengths = np.diag(cell)
+        rmax = 2 * cutoffs.max()
+        if not (
+            atoms.pbc.all()
+            and np.allclose(cell, np.diag(lengths))
+            and rmax < lengths.min() / 2
+        ):
+            return neighbor_list("ijd", atoms, cutoffs)
+
+        positions = atoms.positions % lengths
+        positions[positions >= lengths] = 0.0  # -1e-17 % L rounds to L
+        i, j = cKDTree(positions, boxsize=lengths).query_pairs(rmax, output_type="ndarray").T
+        rij = positions[j] - positions[i]
+        rij -= lengths * np.round(rij / lengths)
+        d = np.linalg.norm(rij, axis=1)
+        within = d < cutoffs[i] + cutoffs[j]
+        i, j, d = i[within], j[within], d[within]
+        return np.concatenate([i, j]), np.concatenate([j, i]), np.concatenate([d, d])
 
+    @staticmethod
+    def shell_averages(atoms, i, j, d):
+        """
+        Per-atom averages of the 6 shortest (d0) and the next 2 (d1)
+        distances to unlike-species neighbors, without a loop over atoms.
+        """
         natoms = len(atoms)
-        orderp = np.zeros(natoms)
-        cutoffs = natural_cutoffs(atoms, mult=skin)
-        nl = NeighborList(cutoffs, bothways=True, self_interaction=False)
-        nl.update(atoms)
+        unlike = atoms.numbers[i] != atoms.numbers[j]
+        i, d = i[unlike], d[unlike]
+        order = np.lexsort((d, i))
+        i, d = i[order], d[order]
+        counts = np.bincount(i, minlength=natoms)
+        if np.any(counts < 8):
+            raise ValueError(
+                f"Atom {np.argmax(counts < 8)} has fewer than 8 neighbors. Check cutoff radius or structure."
+            )
+        rank = np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts)
+        first, second = rank < 6, (rank >= 6) & (rank < 8)
+        d0 = np.bincount(i[first], d[first], minlength=natoms) / 6.0
+        d1 = np.bincount(i[second], d[second], minlength=natoms) / 2.0
+        return d0, d1
 
+    @staticmethod
+    def order_parameter_from_shells(d0, d1, params):
+        """
+        Order parameter from the shell averages, an affine function of d0
+        and d1. Parameters may be arrays broadcasting against d0, e.g. shape
+        (P, 1) to evaluate P parameter sets at once.
+        """
         d0B19 = params["d0B19"]
         d1B19 = params["d1B19"]
         d0B2 = params["d0B2"]
         d1B2 = params["d1B2"]
+        return (d0 * (d1B2 + d1B19) - d1 * (d0B2 + d0B19)) / (d0B2 * (d0B19 - d1B19))
 
-        for i in range(natoms):
-            indices, offsets = nl.get_neighbors(i)
-            itype = atoms[i].symbol
-            distances = []
-
-            for j, offset in zip(indices, offsets):
-                jtype = atoms[j].symbol
-                if itype == jtype:
-                    continue
-                rij = (
-                    atoms.positions[j]
-                    + np.dot(offset, atoms.get_cell())
-                    - atoms.positions[i]
-                )
-                distances.append(np.linalg.norm(rij))
-
-            if len(distances) < 8:
-                raise ValueError(
-                    f"Atom {i} has fewer than 8 neighbors. Check cutoff radius or structure."
-                )
-
-            distances.sort()
-            d0 = sum(distances[:6]) / 6.0
-            d1 = sum(distances[6:8]) / 2.0
-            chi = (d0 * (d1B2 + d1B19) - d1 * (d0B2 + d0B19)) / (d0B2 * (d0B19 - d1B19))
-            orderp[i] = chi
-
-        return orderp
+    @staticmethod
+    def calculate_order_parameter(atoms, params, skin=1.1):
+        """
+        Static method to calculate the order parameter for a given Atoms object.
+        """
+        if not NiTiSystem.is_niti(atoms):
+            print("Skipping order parameter calculation: Not a NiTi system.")
+            return None
+
+        d0, d1 = NiTiSystem.shell_averages(atoms, *NiTiSystem.neighbor_pairs(atoms, skin))
+        return NiTiSystem.order_parameter_from_shells(d0, d1, params)
+
+    def get_domains(self, threshold=0.0, martensite=True):
+        """
+        Label the martensite (op > threshold) or austenite (op <= threshold)
+        domains of this structure, using the cached neighbor pairs of the
+        order parameter calculation. The labels are stored as the "domain"
+        array (-1 for atoms of the other phase).
+
+        Args:
+            threshold: float, order parameter separating B2 (-1) and B19 (+1)
+            martensite: bool, label the op > threshold domains, else op <= threshold
+
+        Returns:
+            dict: see domain_statistics
+        """
+        # Recomputed so op matches the current geometry; with unchanged
+        # positions this reuses the cached shells
+        self._calculate_order_parameter()
+        pairs = self.get_shells()["pairs"]
+        labels = self.label_domains(self.get_array("op"), pairs, threshold, martensite)
+        self.set_array("domain", labels)
+        return self.domain_statistics(self, labels)
+
+    @staticmethod
+    def label_domains(op, pairs, threshold=0.0, martensite=True):
+        """
+        Connected domains of the atoms on one side of threshold: atoms are
+        joined when they are neighbors (pairs from neighbor_pairs) and both
+        in the phase, and the sparse graph is labeled with scipy's
+        connected_components.
+
+        Returns:
+            ndarray: domain label per atom, 0..count-1, -1 for the other phase
+        """
+        i, j = pairs[0], pairs[1]
+        natoms = len(op)
+        selected = op > threshold if martensite else op <= threshold
+        keep = selected[i] & selected[j]
+        adjacency = coo_matrix(
+            (np.ones(np.count_nonzero(keep), dtype=np.int32), (i[keep], j[keep])),
+            shape=(natoms, natoms),
+        ).tocsr()
+        _, components = connected_components(adjacency, directed=False)
+        labels = np.full(natoms, -1)
+        labels[selected] = np.unique(components[selected], return_inverse=True)[1]
+        return labels
+
+    @staticmethod
+    def domain_statistics(atoms, labels):
+        """
+        Count, sizes and centroids of labeled domains. Centroids are
+        periodic means (of the angles of the scaled coordinates), so domains
+        crossing the cell boundary are not averaged across it.
+
+        Returns:
+            dict: "count", "sizes" (count,) and "centroids" (count, 3) in Angstrom
+        """
+        inside = labels >= 0
+        count = int(labels.max()) + 1 if inside.any() else 0
+        sizes = np.bincount(labels[inside], minlength=count)
+        angles = 2 * np.pi * atoms.get_scaled_positions()[inside]
+        centroids = np.empty((count, 3))
+        for k in range(3):
+            c = np.bincount(labels[inside], np.cos(angles[:, k]), minlength=count)
+            s = np.bincount(labels[inside], np.sin(angles[:, k]), minlength=count)
+            centroids[:, k] = np.arctan2(s, c) / (2 * np.pi) % 1.0
+        return {"count": count, "sizes": sizes, "centroids": centroids @ atoms.cell.array}
 
     def write(self, filename, format="extxyz", **kwargs):
         """
@@ -145,6 +285,118 @@ class NiTiSystem(Atoms):
         super().write(filename, format=format, **kwargs)
 
 
+class OrderParameterStatistics:
+    """
+    Streaming reductions of per-frame order parameter arrays, so long
+    trajectories never hold the (frames, atoms) field. Each update()
+    collapses one frame into a row of the time series (mean, variance,
+    min, max, fractions above thresholds and a fixed-bin histogram) and
+    merges it into running Welford moments and a cumulative histogram;
+    the op array itself is not kept.
+    """
+
+    def __init__(self, thresholds=(0.0,), bins=np.linspace(-2.0, 2.0, 41)):
+        """
+        Args:
+            thresholds: sequence of float, op values to report fractions above
+            bins: array, histogram bin edges; values outside are counted in the
+            first and last bins
+        """
+        self.thresholds = np.asarray(thresholds, dtype=float)
+        self.bins = np.asarray(bins, dtype=float)
+        self.times = []
+        self.rows = []  # count, mean, variance, min, max, fractions...
+        self.histograms = []
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.histogram = np.zeros(len(self.bins) - 1, dtype=np.int64)
+
+    def update(self, op, time=None):
+        """
+        Reduce one frame's order parameter array (NaNs are ignored).
+        """
+        op = np.asarray(op, dtype=float)
+        op = op[~np.isnan(op)]
+        n = len(op)
+        histogram = np.histogram(np.clip(op, self.bins[0], self.bins[-1]), self.bins)[0]
+        if n:
+            mean = op.mean()
+            m2 = np.square(op - mean).sum()
+            row = [n, mean, m2 / n, op.min(), op.max()]
+            row += list((op[:, None] > self.thresholds).mean(axis=0))
+            # Chan et al. merge of the frame's moments into the running ones
+            total = self.count + n
+            delta = mean - self.mean
+            self.mean += delta * n / total
+            self.m2 += m2 + delta**2 * self.count * n / total
+            self.count = total
+        else:
+            row = [0] + [np.nan] * (4 + len(self.thresholds))
+        self.times.append(len(self.times) if time is None else time)
+        self.rows.append(row)
+        self.histograms.append(histogram)
+        self.histogram += histogram
+
+    def summary(self):
+        """
+        Returns:
+            dict: count, mean and variance over all atoms and frames, and the
+            cumulative histogram with its bin edges
+        """
+        return {
+            "count": self.count,
+            "mean": self.mean if self.count else np.nan,
+            "variance": self.m2 / self.count if self.count else np.nan,
+            "histogram": self.histogram,
+            "bins": self.bins,
+        }
+
+    def write(self, filename, append=False):
+        """
+        Write the time series: all of it (including per-frame histograms)
+        to a .npz file, otherwise the scalar columns as a text table. With
+        append the series continues the one already in filename, and the
+        moments and cumulative histogram of a .npz file cover both.
+        """
+        # Shapes from the column count, so an empty series writes just the header
+        rows = np.array(self.rows, dtype=float).reshape(len(self.rows), 5 + len(self.thresholds))
+        table = np.column_stack([np.array(self.times, dtype=float), rows])
+        columns = ["time", "count", "mean", "variance", "min", "max"]
+        columns += [f"frac>{t:g}" for t in self.thresholds]
+        append = append and os.path.exists(filename)
+        if filename.endswith(".npz"):
+            histograms = np.array(self.histograms, dtype=np.int64).reshape(len(self.histograms), len(self.bins) - 1)
+            histogram, count, mean, m2 = self.histogram, self.count, self.mean, self.m2
+            if append:
+                with np.load(filename) as old:
+                    table = np.concatenate([old["series"], table])
+                    histograms = np.concatenate([old["histograms"], histograms])
+                    histogram = old["histogram"] + histogram
+                    old_count, old_mean, old_variance = old["moments"]
+                if old_count:
+                    # Chan et al. merge, as in update()
+                    total = old_count + count
+                    delta = mean - old_mean
+                    mean = old_mean + delta * count / total
+                    m2 = old_variance * old_count + m2 + delta**2 * old_count * count / total
+                    count = total
+            np.savez_compressed(
+                filename,
+                columns=np.array(columns),
+                series=table,
+                histograms=histograms,
+                bins=self.bins,
+                histogram=histogram,
+                moments=np.array([count, mean if count else np.nan, m2 / count if count else np.nan]),
+            )
+        elif append:
+            with open(filename, "a") as f:
+                np.savetxt(f, table)
+        else:
+            np.savetxt(filename, table, header=" ".join(columns))
+
+
 if __name__ == "__main__":
     # B2 structure: NiTi with cubic structure
     b2_atoms = NiTiSystem.from_structure(structure="B2")
@@ -0,0 +1,273 @@
+# /// script
+# requires-python = ">=3.10"
+# dependencies = [
+#     "numpy",
+#     "ase",
+#     "h5py",
+# ]
+# author = "Stefan Bringuier <stefan.bringuier@gmail.com>"
+# description = "Benchmarks for vasp_velocities.py and orderparam.py"
+# license = "MIT"
+# ///
+"""Benchmarks for `vasp_velocities.py` and `orderparam.py` on synthetic NiTi trajectories.
+
+Run from the `scripts` directory, e.g.:
+
+    python trajectory_bench.py generate XDATCAR_bench --atoms 16000 --frames 1000
+    python trajectory_bench.py run --sizes 1024x100 16000x1000 --save-baseline traj_baseline.json
+    python trajectory_bench.py run --sizes 1024x100 16000x1000 --baseline traj_baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from ase.build import bulk
+from ase.data import atomic_masses
+
+import vasp_velocities as vv
+from orderparam import NiTiSystem
+
+KB = 8.617333262e-5  # eV/K
+AMU_A2_PS2 = 1.0364269e-4  # eV per amu Angstrom^2/ps^2
+
+
+def b2_supercell(n_atoms: int, a: float = 3.107):
+    """B2 NiTi supercell with at least `n_atoms` atoms, sorted by species
+    so each species is one contiguous block as in an XDATCAR."""
+    reps = max(1, int(np.ceil((n_atoms / 2) ** (1.0 / 3.0))))
+    atoms = bulk("NiTi", "cesiumchloride", a=a) * (reps, reps, reps)
+    return atoms[np.argsort(atoms.numbers, kind="stable")]
+
+
+def thermal_frames(atoms, n_frames: int, dt: float = 0.002,
+                   temperature: float = 300.0, frequency: float = 6.0, seed: int = 0):
+    """Thermalized trajectory of `atoms` as independent Einstein oscillators.
+
+    Every atom vibrates about its lattice site with a frequency spread
+    around `frequency` (THz) and Gaussian amplitudes whose variance is the
+    equipartition value kT / (m w^2), so positions and finite-difference
+    velocities have the statistics of a harmonic crystal at `temperature`.
+    Frames are generated one at a time, wrapped into the cell.
+
+    Yields (positions, velocities) per frame, velocities in Angstrom/ps.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(atoms)
+    omega = 2 * np.pi * frequency * rng.uniform(0.7, 1.3, (n, 1))
+    masses = atomic_masses[atoms.numbers][:, None]
+    sigma = np.sqrt(KB * temperature / (masses * omega**2 * AMU_A2_PS2))
+    a = rng.normal(0.0, 1.0, (n, 3)) * sigma
+    b = rng.normal(0.0, 1.0, (n, 3)) * sigma
+    sites = atoms.get_positions()
+    cell = atoms.cell.array
+    inverse = np.linalg.inv(cell)
+    for t in range(n_frames):
+        c, s = np.cos(omega * t * dt), np.sin(omega * t * dt)
+        positions = sites + a * c + b * s
+        scaled = positions @ inverse
+        scaled -= np.floor(scaled)
+        yield scaled @ cell, omega * (b * c - a * s)
+
+
+def write_xdatcar(filename: str, atoms, frames) -> int:
+    """Stream `(positions, ...)` frames into a VASP 5 XDATCAR of `atoms`'
+    cell and species. Returns the number of frames written."""
+    symbols, counts = np.unique(atoms.get_chemical_symbols(), return_counts=True)
+    order = np.argsort([atoms.get_chemical_symbols().index(s) for s in symbols])
+    inverse = np.linalg.inv(atoms.cell.array)
+    n_frames = 0
+    with open(filename, "w") as f:
+        f.write("synthetic B2 NiTi\n           1\n")
+        np.savetxt(f, atoms.cell.array, fmt="%12.6f")
+        f.write(" ".join(symbols[order]) + "\n")
+        f.write(" ".join(str(c) for c in counts[order]) + "\n")
+        for positions, *_ in frames:
+            n_frames += 1
+            f.write(f"Direct configuration= {n_frames:5d}\n")
+            np.savetxt(f, positions @ inverse, fmt="%.8f")
+    return n_frames
+
+
+def generate(filename: str, n_atoms: int, n_frames: int, **kwargs):
+    """Write a synthetic thermalized B2 NiTi XDATCAR; returns the supercell."""
+    atoms = b2_supercell(n_atoms)
+    write_xdatcar(filename, atoms, thermal_frames(atoms, n_frames, **kwargs))
+    return atoms
+
+
+def parse_size(text: str) -> tuple[int, int]:
+    """ATOMSxFRAMES, e.g. 16000x1000."""
+    atoms, frames = text.lower().split("x")
+    return int(atoms), int(frames)
+
+
+STAGES = (
+    "read_xdatcar",
+    "calculate_velocities",
+    "write_lammps_dump",
+    "calculate_order_parameter",
+)
+
+
+def time_stage(func, repeats: int) -> tuple[float, float]:
+    """Best wall time (s) over `repeats` calls and peak traced memory (MB).
+
+    The memory is measured on a separate first call with tracemalloc, which
+    tracks numpy allocations, so the timings are not slowed by tracing.
+    Allocations in worker processes (parallel XDATCAR parsing) are not seen.
+    """
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best, peak / 2**20
+
+
+def trajectory_stages(xdatcar: str, workdir: str, workers, op_frames: int) -> tuple[dict, int]:
+    """Callables for each stage on one trajectory, and the frames each
+    stage processes (the order parameter only runs on `op_frames`)."""
+    species, positions, cells = vv.read_xdatcar(xdatcar, workers=workers)
+    traj = vv.calculate_velocities(vv.Trajectory(species, positions, cells), 0.002)
+    params = NiTiSystem.default_params
+    op_atoms = [traj.to_atoms(t) for t in range(min(op_frames, len(traj)))]
+    dump = os.path.join(workdir, "dump.lammps")
+    stages = {
+        "read_xdatcar": lambda: vv.read_xdatcar(xdatcar, workers=workers),
+        "calculate_velocities": lambda: vv.calculate_velocities(traj, 0.002),
+        "write_lammps_dump": lambda: vv.write_lammps_dump(traj, output=dump),
+        "calculate_order_parameter": lambda: [
+            NiTiSystem.calculate_order_parameter(atoms, params) for atoms in op_atoms
+        ],
+    }
+    frames = {stage: len(traj) for stage in STAGES}
+    frames["calculate_order_parameter"] = len(op_atoms)
+    return stages, frames
+
+
+def compare_baseline(results: dict, baseline: dict, tolerance: float) -> int:
+    """Print stages that got slower than the baseline by more than
+    `tolerance` (relative). Returns the number of regressions."""
+    regressions = 0
+    for stage, by_size in results.items():
+        old_sizes = baseline.get(stage, {})
+        for size, entry in by_size.items():
+            if size not in old_sizes:
+                continue
+            ratio = entry["time"] / old_sizes[size]["time"]
+            if ratio > 1.0 + tolerance:
+                regressions += 1
+                print(f"REGRESSION {stage:<26} {size:>14}: {ratio:.2f}x baseline")
+    if not regressions:
+        print(f"No regressions beyond {tolerance:.0%} of the baseline.")
+    return regressions
+
+
+def bench_run(args):
+    """Time, peak memory and throughput of each stage per trajectory size."""
+    results = {stage: {} for stage in STAGES}
+    print(f"{'stage':<26} {'size':>14} {'s':>10} {'MB':>9} {'frames/s':>10} {'atoms/s':>10}")
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        for n_atoms, n_frames in args.sizes:
+            xdatcar = os.path.join(workdir, "XDATCAR")
+            atoms = generate(xdatcar, n_atoms, n_frames, seed=args.seed)
+            stages, frames = trajectory_stages(xdatcar, workdir, args.workers, args.op_frames)
+            size = f"{len(atoms)}x{n_frames}"
+            for stage in STAGES:
+                best, peak = time_stage(stages[stage], args.repeats)
+                entry = {
+                    "time": best,
+                    "peak_mb": peak,
+                    "frames_per_s": frames[stage] / best,
+                    "atoms_per_s": frames[stage] * len(atoms) / best,
+                }
+                results[stage][size] = entry
+                print(
+                    f"{stage:<26} {size:>14} {best:>10.3e} {peak:>9.2f} "
+                    f"{entry['frames_per_s']:>10.3e} {entry['atoms_per_s']:>10.3e}"
+                )
+            os.remove(xdatcar)
+            if os.path.exists(xdatcar + ".idx.npz"):
+                os.remove(xdatcar + ".idx.npz")
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+            "workers": args.workers,
+            "op_frames": args.op_frames,
+        },
+        "results": results,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if compare_baseline(results, baseline, args.tolerance):
+            raise SystemExit(1)
+
+
+def bench_generate(args):
+    """Write a synthetic trajectory for use outside the benchmark."""
+    start = time.perf_counter()
+    atoms = generate(args.output, args.atoms, args.frames, dt=args.dt,
+                     temperature=args.temperature, seed=args.seed)
+    print(
+        f"Wrote {args.frames} frames of {len(atoms)} atoms to {args.output} "
+        f"in {time.perf_counter() - start:.1f} s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="Write a synthetic thermalized B2 NiTi XDATCAR")
+    gen.add_argument("output")
+    gen.add_argument("--atoms", type=int, default=1024)
+    gen.add_argument("--frames", type=int, default=100)
+    gen.add_argument("--dt", type=float, default=0.002, help="ps between frames")
+    gen.add_argument("--temperature", type=float, default=300.0)
+    gen.add_argument("--seed", type=int, default=0)
+    gen.set_defaults(func=bench_generate)
+
+    run = sub.add_parser("run", help="Per-stage time, memory and throughput")
+    run.add_argument("--sizes", type=parse_size, nargs="+",
+                     default=[(1024, 10), (1024, 1000), (16000, 100)],
+                     help="ATOMSxFRAMES trajectories to benchmark")
+    run.add_argument("--workers", type=int, default=None,
+                     help="Processes parsing the XDATCAR")
+    run.add_argument("--op-frames", type=int, default=1,
+                     help="Frames to compute the order parameter on")
+    run.add_argument("--repeats", type=int, default=3)
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--workdir", help="Directory for the generated files")
+    run.add_argument("--save-baseline", help="Write results to a JSON file")
+    run.add_argument("--baseline", help="Compare against a baseline JSON")
+    run.add_argument("--tolerance", type=float, default=0.25,
+                     help="Allowed relative slowdown vs. the baseline")
+    run.set_defaults(func=bench_run)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,14 @@
 import argparse
+import itertools
+import mmap
+import os
+import re
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from ase.io import read, write
+from ase import Atoms
+from ase.data import atomic_masses, atomic_numbers, chemical_symbols
+from ase.io import write
 
 __author__ = "Stefan Bringuier"
 __email__ = "stefanbringuier@gmail.com"
@@ -9,6 +17,322 @@ __description__ = """Finite-difference approximation of velocities from XDATCAR
                      to use for autocorrelation and other types of analysis as done in https://doi.org/10.5281/zenodo.10573320.
                   """
 
+# <varray><v>x y z</v>...</varray> as an (n, 3) array with one numeric parse for all rows
+def _varray(elem):
+    text = " ".join(v.text for v in elem)
+    return np.fromstring(text, sep=" ").reshape(-1, 3)
+
+def vasprun_info(filename):
+    '''
+        Species, POTIM and NBLOCK of a vasprun.xml, reading only the header
+        up to the first ionic step.
+
+    - filename: str - path to vasprun.xml
+    - returns: (list(str), float, int) - species, potim (fs), nblock
+    '''
+    species = []
+    params = {}
+    with open(filename, "rb") as f:
+        for event, elem in ET.iterparse(f, events=("start", "end")):
+            if event == "start":
+                if elem.tag == "calculation":
+                    break
+                continue
+            if elem.tag == "i" and elem.get("name") in ("POTIM", "NBLOCK"):
+                # <parameters> comes after <incar> and holds the values VASP used
+                params[elem.get("name")] = elem.text.strip()
+            elif elem.tag == "array" and elem.get("name") == "atoms":
+                species = [rc[0].text.strip() for rc in elem.find("set")]
+    potim = float(params.get("POTIM", 0.5))
+    nblock = int(params.get("NBLOCK", 1))
+    return species, potim, nblock
+
+# Per-step blocks of a vasprun.xml that hold most of its bytes and are never needed here
+VASPRUN_SKIP_RE = re.compile(rb"<(scstep|eigenvalues\w*|dos\w*|projected\w*)[\s>]")
+
+def _skip_blocks(f, chunk_size=1 << 22):
+    # Bytes of f with the VASPRUN_SKIP_RE blocks cut out before XML parsing
+    buf = b""
+    closing = None  # End tag of the block being skipped
+    while True:
+        data = f.read(chunk_size)
+        buf += data
+        out = []
+        pos = 0
+        while pos < len(buf):
+            if closing is not None:
+                i = buf.find(closing, pos)
+                if i < 0:
+                    pos = max(pos, len(buf) - len(closing))
+                    break
+                pos = i + len(closing)
+                closing = None
+            else:
+                m = VASPRUN_SKIP_RE.search(buf, pos)
+                if m is None:
+                    # A start tag may straddle two chunks
+                    end = len(buf) if not data else max(pos, len(buf) - 64)
+                    out.append(buf[pos:end])
+                    pos = end
+                    break
+                out.append(buf[pos:m.start()])
+                closing = b"</" + m.group(1) + b">"
+                pos = m.end()
+        buf = buf[pos:]
+        yield b"".join(out)
+        if not data:
+            return
+
+def iter_vasprun(filename):
+    '''
+        Stream the ionic steps of a vasprun.xml without building the full
+        tree or ASE calculators. The electronic steps, eigenvalues and DOS
+        blocks are skipped before parsing, only the structure of each
+        <calculation> is converted, and finished steps are cleared so memory
+        stays flat. A truncated file (running job) ends at the last complete
+        step.
+
+    - filename: str - path to vasprun.xml
+    - yields: (ndarray, ndarray) - cartesian positions (natoms, 3), cell (3, 3)
+    '''
+    parser = ET.XMLPullParser(events=("start", "end"))
+    path = []
+    frame = None
+    with open(filename, "rb") as f:
+        try:
+            for chunk in _skip_blocks(f):
+                parser.feed(chunk)
+                for event, elem in parser.read_events():
+                    if event == "start":
+                        if not path:
+                            root = elem
+                        path.append(elem.tag)
+                        continue
+                    path.pop()
+                    if elem.tag == "structure" and path[-1:] == ["calculation"]:
+                        cell = _varray(elem.find("crystal/varray[@name='basis']"))
+                        scaled = _varray(elem.find("varray[@name='positions']"))
+                        frame = (scaled @ cell, cell)
+                    elif elem.tag == "calculation":
+                        if frame is not None:
+                            yield frame
+                        frame = None
+                        root.clear()  # Drop the finished step and everything before it
+        except ET.ParseError:
+            return
+
+def xdatcar_header(filename):
+    '''
+        Title, species (one per atom) and cell of the first frame of a VASP 5
+        XDATCAR.
+
+    - filename: str - path to XDATCAR
+    - returns: (bytes, list(str), ndarray) - title line, species, cell (3, 3)
+    '''
+    with open(filename, "rb") as f:
+        lines = [f.readline() for _ in range(7)]
+    scale = float(lines[1])
+    cell = np.array([line.split() for line in lines[2:5]], dtype=float) * scale
+    symbols = lines[5].decode().split()
+    counts = [int(n) for n in lines[6].split()]
+    species = [s for s, n in zip(symbols, counts) for _ in range(n)]
+    return lines[0].rstrip(b"\r\n"), species, cell
+
+def xdatcar_index(filename):
+    '''
+        Byte offsets of the frames of an XDATCAR, built with one scan of the
+        file and cached next to it as <filename>.idx.npz (rebuilt when the
+        file's size or mtime changes).
+
+    - filename: str - path to XDATCAR
+    - returns: (ndarray, ndarray) - offsets of each "Direct configuration=" line
+               and of each frame's header; header offsets are only per frame
+               for variable-cell runs, otherwise just [0]
+    '''
+    st = os.stat(filename)
+    index_file = f"{filename}.idx.npz"
+    try:
+        with np.load(index_file) as idx:
+            if idx["size"] == st.st_size and idx["mtime_ns"] == st.st_mtime_ns:
+                return idx["offsets"], idx["header_offsets"]
+    except (FileNotFoundError, KeyError, ValueError, OSError):
+        pass
+
+    title = xdatcar_header(filename)[0]
+    offsets = []
+    header_offsets = [0]
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = mm.find(b"configuration=")
+        while pos >= 0:
+            offsets.append(mm.rfind(b"\n", 0, pos) + 1)
+            pos = mm.find(b"configuration=", pos + 14)
+        # Variable-cell runs repeat the header (starting with the title) before every frame
+        pos = mm.find(b"\n" + title + b"\n") if title.strip() else -1
+        while pos >= 0:
+            header_offsets.append(pos + 1)
+            pos = mm.find(b"\n" + title + b"\n", pos + 1)
+    offsets = np.array(offsets, dtype=np.int64)
+    header_offsets = np.array(header_offsets, dtype=np.int64)
+    try:
+        np.savez(index_file, offsets=offsets, header_offsets=header_offsets,
+                 size=st.st_size, mtime_ns=st.st_mtime_ns)
+    except OSError:
+        pass  # Read-only directory, the index is rebuilt next time
+    return offsets, header_offsets
+
+def _parse_xdatcar_block(filename, start, end, natoms, header_lines, cell):
+    # Cartesian positions (F, natoms, 3) and cells (F, 3, 3) of the frames in bytes [start, end)
+    with open(filename, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+    block = header_lines + 1 + natoms
+    nframes = len(lines) // block  # An incomplete last frame (running job) is dropped
+    lines = np.array(lines[:nframes * block], dtype=object).reshape(nframes, block)
+    scaled = np.fromstring(b" ".join(lines[:, -natoms:].ravel()), sep=" ").reshape(nframes, natoms, 3)
+    if header_lines:
+        scale = np.array(lines[:, 1], dtype=float)
+        cells = np.fromstring(b" ".join(lines[:, 2:5].ravel()), sep=" ").reshape(nframes, 3, 3)
+        cells *= scale[:, None, None]
+    else:
+        cells = np.broadcast_to(cell, (nframes, 3, 3)).copy()
+    return scaled @ cells, cells
+
+def _xdatcar_tasks(filename, index, chunk_frames):
+    # Species, selected frame numbers and _parse_xdatcar_block() arguments
+    # covering them in ranges of chunk_frames frames
+    _, species, cell = xdatcar_header(filename)
+    offsets, header_offsets = xdatcar_index(filename)
+    variable_cell = len(header_offsets) == len(offsets) > 1
+    starts = header_offsets if variable_cell else offsets
+    header_lines = 7 if variable_cell else 0
+
+    # A running job leaves an incomplete last frame, which is not counted
+    # before the selection is applied (so -1 is the last complete frame)
+    nframes = len(offsets)
+    if nframes:
+        with open(filename, "rb") as f:
+            f.seek(starts[-1])
+            tail = f.read()
+        lines = tail.splitlines()
+        block = header_lines + 1 + len(species)
+        if len(lines) < block or (len(lines) == block and not tail.endswith(b"\n")):
+            nframes -= 1
+
+    frames = range(nframes)[index]
+    tasks = []
+    if len(frames):
+        first, last = min(frames), max(frames)
+        size = os.path.getsize(filename)
+        for lo in range(first, last + 1, chunk_frames):
+            hi = min(lo + chunk_frames, last + 1)
+            end = starts[hi] if hi < len(starts) else size
+            tasks.append((filename, starts[lo], end, len(species), header_lines, cell))
+    return species, frames, tasks
+
+def read_xdatcar(filename, index=slice(None), workers=None, chunk_frames=2000):
+    '''
+        Read frames of an XDATCAR through its byte-offset index: only the
+        requested frames are read (seeking to them), and ranges of frames are
+        parsed in parallel processes with one numeric parse per range.
+
+    - filename: str - path to XDATCAR
+    - index: slice - frames to read
+    - workers: int - processes, default os.cpu_count(); 1 parses serially
+    - chunk_frames: int - frames per parallel task
+    - returns: (list(str), ndarray, ndarray) - species, positions (F, N, 3), cells (F, 3, 3)
+    '''
+    species, frames, tasks = _xdatcar_tasks(filename, index, chunk_frames)
+    if len(frames) == 0:
+        return species, np.zeros((0, len(species), 3)), np.zeros((0, 3, 3))
+    first = min(frames)
+
+    if workers == 1 or len(tasks) == 1:
+        results = [_parse_xdatcar_block(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_parse_xdatcar_block, *zip(*tasks)))
+    positions = np.concatenate([r[0] for r in results])
+    cells = np.concatenate([r[1] for r in results])
+    selection = np.asarray(frames) - first
+    selection = selection[selection < len(positions)]  # Dropped incomplete last frame
+    return species, positions[selection], cells[selection]
+
+def iter_xdatcar(filename, index=slice(None), chunk_frames=2000):
+    '''
+        Stream the frames of an XDATCAR one range of chunk_frames frames at a
+        time, so memory stays bounded by one range whatever the file size.
+
+    - filename: str - path to XDATCAR
+    - index: slice - frames to read, yielded in selection order like read_xdatcar()
+    - returns: (list(str), generator) - species, (positions, cell) per frame
+    '''
+    species, frames, tasks = _xdatcar_tasks(filename, index, chunk_frames)
+    selected = np.asarray(frames, dtype=np.int64)
+
+    def frames_of(tasks):
+        if len(selected) == 0:
+            return
+        first = selected.min()
+        ranges = (selected - first) // chunk_frames
+        # Ranges are visited in selection order (backwards for negative steps)
+        for r in dict.fromkeys(ranges.tolist()):
+            positions, cells = _parse_xdatcar_block(*tasks[r])
+            lo = first + r * chunk_frames
+            for t in selected[ranges == r]:
+                if t - lo < len(positions):  # Dropped incomplete last frame
+                    yield positions[t - lo], cells[t - lo]
+    return species, frames_of(tasks)
+
+def iter_frames(input, frames=slice(None), timestep=0.001):
+    '''
+        Stream the selected frames of a vasprun.xml or XDATCAR.
+
+    - input: str - vasprun.xml (*xml) or XDATCAR
+    - frames: slice - frames to read
+    - timestep: float - time in picoseconds between XDATCAR frames
+    - returns: (list(str), float, iterable) - species, time between the
+               selected frames in picoseconds, (positions, cell) per frame
+    '''
+    stride = frames.step or 1
+    if input.endswith('xml'):
+        species, potim, nblock = vasprun_info(input)
+        steps = iter_vasprun(input)
+        if stride > 0 and all(i is None or i >= 0 for i in (frames.start, frames.stop)):
+            steps = itertools.islice(steps, frames.start, frames.stop, frames.step)
+        else:
+            steps = list(steps)[frames]
+        return species, (potim / 1000) * nblock * stride, steps
+    species, steps = iter_xdatcar(input, frames)
+    return species, timestep * stride, steps
+
+def frame_numbers(input, frames=slice(None)):
+    '''
+        Numbers in the whole trajectory of the frames iter_frames() selects.
+        Only selections counted from the end (negative start, stop or step)
+        need the number of frames, which costs a pass over a vasprun.xml.
+
+    - input: str - vasprun.xml (*xml) or XDATCAR
+    - frames: slice - frames to read
+    - returns: iterable of int
+    '''
+    stride = frames.step or 1
+    if stride > 0 and all(i is None or i >= 0 for i in (frames.start, frames.stop)):
+        return itertools.count(frames.start or 0, stride)
+    if input.endswith('xml'):
+        nframes = sum(1 for _ in iter_vasprun(input))
+    else:
+        nframes = len(_xdatcar_tasks(input, slice(None), 2000)[1])
+    return range(nframes)[frames]
+
+def parse_frames(text):
+    '''
+        START:STOP[:STEP] frame selection as a slice (e.g. "40000:50000").
+    '''
+    parts = [int(p) if p else None for p in text.split(":")]
+    if len(parts) == 1:
+        return slice(parts[0], parts[0] + 1 or None)
+    return slice(*parts)
+
 # Function to apply periodic boundary conditions to displacements
 def apply_pbc(displacement, box_lengths):
     for i in range(3):
@@ -18,89 +342,421 @@ def apply_pbc(displacement, box_lengths):
             displacement[i] += box_lengths[i]
     return displacement
 
+# Vectorized apply_pbc() on an (..., 3) array of displacements, in place
+def _minimum_image(displacement, box_lengths):
+    displacement -= box_lengths * (displacement > box_lengths / 2)
+    displacement += box_lengths * (displacement < -box_lengths / 2)
+    return displacement
+
+def stream_velocities(frames, dt=0.001):
+    '''
+        Finite-difference velocities of a stream of frames, as
+        calculate_velocities() but holding only one frame of look-ahead.
+
+    - frames: iterable of (positions, cell)
+    - dt: float - time between frames in picoseconds
+    - returns: generator of (positions, velocities, cell)
+    '''
+    previous = velocities = None
+    for positions, cell in frames:
+        if previous is None:
+            box_lengths = np.linalg.norm(cell, axis=1)
+        else:
+            velocities = _minimum_image(positions - previous[0], box_lengths) / dt
+            yield previous[0], velocities, previous[1]
+        previous = positions, cell
+    if previous is not None:
+        # Backward difference for the last frame
+        yield previous[0], np.zeros_like(previous[0]) if velocities is None else velocities, previous[1]
+
+class Trajectory:
+    """
+        Array-backed trajectory. Species and masses are stored once for all
+        frames, positions and velocities as (frames, atoms, 3) arrays (float32
+        halves the memory) and cells as a (frames, 3, 3) array. ASE Atoms are
+        only built on demand with to_atoms().
+    """
+
+    def __init__(self, species, positions, cells, velocities=None, dtype=np.float64, arrays=None):
+        self.species = list(species)
+        self.numbers = np.array([atomic_numbers[s] for s in self.species])
+        self.masses = atomic_masses[self.numbers]
+        self.positions = np.asarray(positions, dtype=dtype)
+        self.cells = np.asarray(cells, dtype=np.float64)
+        self.velocities = None if velocities is None else np.asarray(velocities, dtype=dtype)
+        self.arrays = dict(arrays or {})  # Extra per-atom arrays (frames, atoms, ...), e.g. op
+
+    @classmethod
+    def from_frames(cls, species, frames, dtype=np.float64):
+        # From an iterable of (positions, cell), e.g. iter_vasprun(), growing the arrays in place
+        natoms = len(species)
+        positions = np.empty((0, natoms, 3), dtype=dtype)
+        cells = np.empty((0, 3, 3))
+        n = 0
+        for pos, cell in frames:
+            if n == len(positions):
+                capacity = max(16, 2 * n)
+                positions.resize((capacity, natoms, 3), refcheck=False)
+                cells.resize((capacity, 3, 3), refcheck=False)
+            positions[n] = pos
+            cells[n] = cell
+            n += 1
+        # Trim the doubling buffer in place so the spare capacity is freed
+        positions.resize((n, natoms, 3), refcheck=False)
+        cells.resize((n, 3, 3), refcheck=False)
+        return cls(species, positions, cells, dtype=dtype)
+
+    @classmethod
+    def from_atoms(cls, images, dtype=np.float64):
+        velocities = None
+        if images[0].has('momenta'):
+            velocities = [atoms.get_velocities() for atoms in images]
+        return cls(images[0].get_chemical_symbols(),
+                   [atoms.get_positions() for atoms in images],
+                   [atoms.cell.array for atoms in images],
+                   velocities=velocities, dtype=dtype)
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def natoms(self):
+        return len(self.species)
+
+    def to_atoms(self, t):
+        atoms = Atoms(numbers=self.numbers, positions=self.positions[t], cell=self.cells[t], pbc=True)
+        if self.velocities is not None:
+            atoms.set_velocities(self.velocities[t])
+        for name, values in self.arrays.items():
+            atoms.set_array(name, values[t])
+        return atoms
+
+    def iter_atoms(self):
+        for t in range(len(self)):
+            yield self.to_atoms(t)
+
 # Function to calculate velocities using finite differences
-def calculate_velocities(frames, dt=0.001):
+def calculate_velocities(frames, dt=0.001, chunk_frames=4096):
     '''
         Use forward/backward difference approximation to calculate velocities.
+        Displacements are wrapped to the minimum image of the first frame's
+        (orthorhombic) box like apply_pbc(), chunk_frames frames at a time.
 
-    - frames: list(ASE.Atoms)
+    - frames: Trajectory or list(ASE.Atoms) - velocities are stored in it
     - dt: float - default time unit is 0.001 picoseconds
+    - returns: Trajectory
     '''
-    natoms = len(frames[0])
-    box_lengths = frames[0].get_cell().lengths()
-
-    num_frames = len(frames)
-
-    for t in range(num_frames):
-        velocities = np.zeros((natoms, 3))
-        if t < num_frames - 1:
-            # Forward difference for all frames except the last
-            positions_curr = frames[t].get_positions()
-            positions_next = frames[t + 1].get_positions()
-            for i in range(natoms):
-                displacement = positions_next[i] - positions_curr[i]
-                displacement = apply_pbc(displacement, box_lengths)
-                velocities[i, :] = displacement / dt
-        else:
-            # Backward difference for the last frame
-            positions_curr = frames[t].get_positions()
-            positions_prev = frames[t - 1].get_positions()
-            for i in range(natoms):
-                displacement = positions_curr[i] - positions_prev[i]
-                displacement = apply_pbc(displacement, box_lengths)
-                velocities[i, :] = displacement / dt
+    traj = frames if isinstance(frames, Trajectory) else Trajectory.from_atoms(frames)
+    positions = traj.positions
+    box_lengths = np.linalg.norm(traj.cells[0], axis=1).astype(positions.dtype)
+    num_frames = len(traj)
 
-        frames[t].set_velocities(velocities)
+    velocities = np.zeros_like(positions)
+    for lo in range(0, num_frames - 1, chunk_frames):
+        hi = min(lo + chunk_frames, num_frames - 1)
+        # Forward difference for all frames except the last
+        displacement = velocities[lo:hi]
+        np.subtract(positions[lo + 1:hi + 1], positions[lo:hi], out=displacement)
+        _minimum_image(displacement, box_lengths)
+        displacement /= dt
+    if num_frames > 1:
+        # Backward difference for the last frame
+        velocities[-1] = velocities[-2]
+    traj.velocities = velocities
+
+    if traj is not frames:
+        for atoms, v in zip(frames, velocities):
+            atoms.set_velocities(v)
+    return traj
+
+def unwrap_positions(traj, remove_drift=True):
+    '''
+        Unwrapped positions: the minimum-image displacements between
+        consecutive frames (as in apply_pbc()) accumulated with one cumulative
+        sum from the first frame. The sum is accumulated in float64 whatever
+        the trajectory dtype, as float32 rounding would grow with the frames.
+
+    - traj: Trajectory
+    - remove_drift: bool - subtract the center-of-mass displacement of each frame
+    - returns: ndarray (frames, atoms, 3) of float64
+    '''
+    positions = traj.positions
+    box_lengths = np.linalg.norm(traj.cells[0], axis=1)
+    unwrapped = np.empty(positions.shape)
+    unwrapped[0] = positions[0]
+    displacement = unwrapped[1:]
+    np.subtract(positions[1:], positions[:-1], out=displacement, dtype=np.float64)
+    _minimum_image(displacement, box_lengths)
+    np.cumsum(unwrapped, axis=0, out=unwrapped)
+    if remove_drift:
+        weights = traj.masses / traj.masses.sum()
+        com = np.einsum('fij,i->fj', unwrapped, weights)
+        unwrapped -= (com - com[0])[:, None, :]
+    return unwrapped
+
+def msd_fft(x):
+    '''
+        Mean-squared displacement over all time origins, for every atom,
+        with the FFT algorithm: MSD(m) = S1(m) - 2 S2(m), where S2 is the
+        position autocorrelation. O(F log F) instead of O(F^2) per atom.
+
+    - x: ndarray (frames, atoms, 3) - unwrapped positions
+    - returns: ndarray (frames, atoms) - MSD at lag m for each atom
+    '''
+    num_frames = len(x)
+    lags = np.arange(num_frames)
+    counts = (num_frames - lags)[:, None]
+
+    # S2: autocorrelation via zero-padded FFT, summed over x, y, z
+    nfft = 1 << (2 * num_frames - 1).bit_length()
+    f = np.fft.rfft(x, n=nfft, axis=0)
+    s2 = np.fft.irfft(f * f.conj(), n=nfft, axis=0)[:num_frames].sum(axis=-1) / counts
+
+    # S1: running sums of |r(t)|^2 from both ends
+    d = np.square(x).sum(axis=-1)
+    d = np.append(d, np.zeros((1, d.shape[1])), axis=0)
+    q = 2 * d.sum(axis=0)
+    s1 = np.empty((num_frames, x.shape[1]))
+    for m in range(num_frames):
+        q = q - d[m - 1] - d[num_frames - m]
+        s1[m] = q / (num_frames - m)
+    return s1 - 2 * s2
+
+def mean_squared_displacement(traj, chunk_atoms=256, remove_drift=True):
+    '''
+        Species-resolved multiple-time-origin MSD of a trajectory, computed
+        with msd_fft() on chunk_atoms atoms at a time to bound memory.
+
+    - traj: Trajectory
+    - returns: dict - species (and 'all') -> MSD (frames,) in Angstrom^2
+    '''
+    unwrapped = unwrap_positions(traj, remove_drift)
+    species = np.array(traj.species)
+    total = np.zeros((len(traj), traj.natoms))
+    for lo in range(0, traj.natoms, chunk_atoms):
+        hi = min(lo + chunk_atoms, traj.natoms)
+        total[:, lo:hi] = msd_fft(unwrapped[:, lo:hi])
+    msd = {s: total[:, species == s].mean(axis=1) for s in dict.fromkeys(traj.species)}
+    msd['all'] = total.mean(axis=1)
+    return msd
+
+def diffusion_coefficients(msd, dt, fit_range=(0.1, 0.5)):
+    '''
+        Einstein relation D = slope / 6 from a linear fit of MSD(t) over the
+        fit_range fraction of the lags (the short ballistic part and the
+        poorly averaged long lags are left out).
+
+    - msd: dict - from mean_squared_displacement()
+    - dt: float - time between frames in ps
+    - returns: dict - species -> D in Angstrom^2/ps (1 A^2/ps = 1e-4 cm^2/s)
+    '''
+    coefficients = {}
+    for s, values in msd.items():
+        lo = int(fit_range[0] * len(values))
+        hi = max(int(fit_range[1] * len(values)), lo + 2)
+        t = np.arange(lo, hi) * dt
+        slope = np.polyfit(t, values[lo:hi], 1)[0]
+        coefficients[s] = slope / 6
+    return coefficients
+
+def write_msd(msd, dt, output):
+    names = list(msd)
+    table = np.column_stack([np.arange(len(msd[names[0]])) * dt] + [msd[s] for s in names])
+    np.savetxt(output, table, header='time(ps) ' + ' '.join(f'msd_{s}(A^2)' for s in names))
 
 def write_lammps_dump(frames,output="dump.lammps"):
     """
         Crude LAMMPS dump. Not tested for triclinic boxes.
     """
+    traj = frames if isinstance(frames, Trajectory) else Trajectory.from_atoms(frames)
     # Determine unique mass types and assign type IDs
-    mass_types = sorted(set(frames[0].get_masses()))
+    mass_types = sorted(set(traj.masses))
     mass_to_type = {mass: i + 1 for i, mass in enumerate(mass_types)}
+    ids = np.arange(1, traj.natoms + 1)
+    types = np.array([mass_to_type[m] for m in traj.masses])
+    fmt = '%d %d %.10g %.10g %.10g %.10g %.10g %.10g'
 
-    with open('dump.lammps', 'w') as dump_file:
-        for t, atoms in enumerate(frames):
+    with open(output, 'w') as dump_file:
+        for t in range(len(traj)):
             dump_file.write('ITEM: TIMESTEP\n')
             dump_file.write(f'{t}\n')
             dump_file.write('ITEM: NUMBER OF ATOMS\n')
-            dump_file.write(f'{len(atoms)}\n')
+            dump_file.write(f'{traj.natoms}\n')
             dump_file.write('ITEM: BOX BOUNDS pp pp pp\n')
-            cell = atoms.get_cell()
+            cell = traj.cells[t]
             for i in range(3):
                 dump_file.write(f'0.0 {cell[i, i]}\n')
             dump_file.write('ITEM: ATOMS id type x y z vx vy vz\n')
 
-            pos = atoms.get_positions()
-            vel = atoms.get_velocities()
+            table = np.column_stack([ids, types, traj.positions[t], traj.velocities[t]])
+            np.savetxt(dump_file, table, fmt=fmt)
 
-            for i, atom in enumerate(atoms):
-                atom_type = mass_to_type[atom.mass]
-                dump_file.write(f'{i+1} {atom_type} {pos[i][0]} {pos[i][1]} {pos[i][2]} {vel[i][0]} {vel[i][1]} {vel[i][2]}\n')
+def write_extxyz(traj, output):
+    # Atoms are only built one frame at a time while writing
+    write(output, traj.iter_atoms(), format="extxyz")
 
-def main(input,output,timestep=0.001):
+class H5MDWriter:
+    """
+        Chunked, compressed H5MD (https://www.nongnu.org/h5md/) output.
+        Positions, velocities and box edges are stored as time-dependent
+        /particles/all/{position,velocity,box/edges} groups with value, step
+        and time datasets that grow along the frame axis, chunked in blocks
+        of chunk_frames frames and gzip compressed (lossless, with byte
+        shuffling). Species (atomic numbers) and masses are stored once.
+        Extra per-atom arrays (e.g. op) passed to append() are stored the same
+        way under /particles/all/<name>.
+        With append=True frames are added to the end of an existing file.
+    """
+
+    def __init__(self, filename, species, append=False, dtype=np.float64,
+                 chunk_frames=64, compression='gzip', compression_opts=4):
+        import h5py
+        self.numbers = np.array([atomic_numbers[s] for s in species])
+        self.chunk_frames = chunk_frames
+        self.options = dict(compression=compression, compression_opts=compression_opts, shuffle=True)
+        natoms = len(self.numbers)
+        self.file = h5py.File(filename, 'a' if append else 'w')
+        if 'particles/all' in self.file:
+            self.group = self.file['particles/all']
+            if not np.array_equal(self.group['species'][()], self.numbers):
+                self.file.close()
+                raise ValueError(f"{filename} holds a different set of atoms")
+            return
+
+        # An appended file may already have the h5md metadata but no particles
+        h5md = self.file.require_group('h5md')
+        h5md.attrs['version'] = np.array([1, 1])
+        h5md.require_group('author').attrs['name'] = os.environ.get('USER', 'unknown')
+        creator = h5md.require_group('creator')
+        creator.attrs['name'] = 'vasp_velocities.py'
+        creator.attrs['version'] = '1.0'
+
+        self.group = self.file.create_group('particles/all')
+        self.group.create_dataset('species', data=self.numbers)
+        self.group.create_dataset('mass', data=atomic_masses[self.numbers])
+        box = self.group.create_group('box')
+        box.attrs['dimension'] = 3
+        box.attrs['boundary'] = np.array([b'periodic'] * 3)
+
+        self._create('position', (natoms, 3), dtype).attrs['unit'] = 'angstrom'
+        self._create('velocity', (natoms, 3), dtype).attrs['unit'] = 'angstrom ps-1'
+        self._create('box/edges', (3, 3), np.float64).attrs['unit'] = 'angstrom'
+
+    def _create(self, name, shape, dtype):
+        # Empty time-dependent H5MD element, returns its value dataset
+        chunk_frames = self.chunk_frames
+        element = self.group.create_group(name)
+        element.create_dataset('step', shape=(0,), maxshape=(None,), chunks=(chunk_frames,), dtype=np.int64)
+        element.create_dataset('time', shape=(0,), maxshape=(None,), chunks=(chunk_frames,), dtype=np.float64)
+        element['time'].attrs['unit'] = 'ps'
+        return element.create_dataset('value', shape=(0,) + shape, maxshape=(None,) + shape,
+                                      chunks=(chunk_frames,) + shape, dtype=dtype, **self.options)
+
+    def __len__(self):
+        return len(self.group['position/step'])
+
+    def append(self, positions, velocities, cells, dt, step=None, **arrays):
+        # Block of frames (frames, atoms, 3), (frames, atoms, 3), (frames, 3, 3)
+        # and (frames, atoms, ...) arrays, continuing the steps and times of the
+        # frames already in the file, or at the given (frames,) steps and
+        # times dt * step
+        n = len(positions)
+        start = len(self)
+        for name, value in arrays.items():
+            if name not in self.group:
+                if start:
+                    raise ValueError(f"Cannot add '{name}' to a file that already has frames without it")
+                value = np.asarray(value)
+                self._create(name, value.shape[1:], value.dtype)
+        if step is None:
+            step = np.arange(n)
+            time = dt * step
+            if start:
+                step += self.group['position/step'][-1] + 1
+                time += self.group['position/time'][-1] + dt
+        else:
+            step = np.asarray(step, dtype=np.int64)
+            time = dt * step
+        elements = {'position': positions, 'velocity': velocities, 'box/edges': cells, **arrays}
+        for name, value in elements.items():
+            element = self.group[name]
+            for key, data in (('value', value), ('step', step), ('time', time)):
+                element[key].resize(start + n, axis=0)
+                element[key][start:] = data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def write_h5md(traj, output, dt, append=False, chunk_frames=64):
+    with H5MDWriter(output, traj.species, append=append, dtype=traj.positions.dtype,
+                    chunk_frames=chunk_frames) as writer:
+        for lo in range(0, len(traj), chunk_frames):
+            hi = lo + chunk_frames
+            writer.append(traj.positions[lo:hi], traj.velocities[lo:hi], traj.cells[lo:hi], dt)
+
+def read_h5md(filename, index=slice(None)):
+    '''
+        Read frames from an H5MD file written by H5MDWriter. Only the chunks
+        holding the selected frames are read and decompressed.
+
+    - filename: str
+    - index: int or slice - frames to read
+    - returns: Trajectory
+    '''
+    import h5py
+    with h5py.File(filename, 'r') as f:
+        group = f['particles/all']
+        if isinstance(index, (int, np.integer)):
+            index = slice(index, index + 1 if index != -1 else None)
+        species = [chemical_symbols[z] for z in group['species'][()]]
+        positions = group['position/value'][index]
+        arrays = {name: group[name]['value'][index] for name in group
+                  if name not in ('position', 'velocity', 'box') and isinstance(group[name], h5py.Group)}
+        return Trajectory(species, positions, group['box/edges/value'][index],
+                          velocities=group['velocity/value'][index], dtype=positions.dtype, arrays=arrays)
+
+def main(input,output,timestep=0.001,frames=slice(None),workers=None,dtype=np.float64,msd_output=None,
+         append=False):
     """
     timestep is the time in picoseconds between frames!
+    frames selects the frames to read, workers the processes parsing an XDATCAR
+    and dtype the precision of the stored positions and velocities. With
+    msd_output the species-resolved MSD is written there and the diffusion
+    coefficients are printed. Outputs ending in .h5/.h5md are written as H5MD,
+    and with append the frames are added to an existing file.
     """
 
-    # Read all frames using ASE
+    # Read the selected frames
     if input.endswith('xml'):
-        frames = read(input, format='vasp-xml', index=':')
-        potim = frames[0].calc.parameters['potim']
-        nblock = frames[0].calc.parameters['nblock']
-        dt = (potim / 1000) * nblock
+        species, dt, steps = iter_frames(input, frames)
+        traj = Trajectory.from_frames(species, steps, dtype=dtype)
     else:
-        frames = read(input, format='vasp-xdatcar', index=':')
-        dt = timestep
+        stride = frames.step or 1
+        species, positions, cells = read_xdatcar(input, frames, workers=workers)
+        traj = Trajectory(species, positions, cells, dtype=dtype)
+        dt = timestep * stride
 
     # Calculate velocities
-    calculate_velocities(frames, dt)
- 
-    if output.startswith('dump') or output.endswith('dump'):
-        write_lammps_dump(frames,output=output)
+    calculate_velocities(traj, dt)
+
+    if msd_output:
+        msd = mean_squared_displacement(traj)
+        write_msd(msd, dt, msd_output)
+        for s, d in diffusion_coefficients(msd, dt).items():
+            print(f"D({s}) = {d:.6g} A^2/ps = {d * 1e-4:.6g} cm^2/s")
+
+    if output.endswith(('.h5', '.h5md')):
+        write_h5md(traj, output, dt, append=append)
+    elif output.startswith('dump') or output.endswith('dump'):
+        write_lammps_dump(traj,output=output)
     else:
-        write(output,format="extxyz")
+        write_extxyz(traj, output)
 
 if __name__ == "__main__":
     """
@@ -110,8 +766,17 @@ if __name__ == "__main__":
     """
     parser = argparse.ArgumentParser(description=__description__)
     parser.add_argument('input', help='Input file (vasprun.xml or XDATCAR)')
-    parser.add_argument('output', help='Output file (e.g., dump.lammps or output.extxyz)')
+    parser.add_argument('output', help='Output file (e.g., dump.lammps, output.extxyz or output.h5md)')
     parser.add_argument('--timestep', type=float, default=0.001, help='Timestep in picoseconds between frames')
+    parser.add_argument('--frames', type=parse_frames, default=slice(None),
+                        help='Frames to use as START:STOP[:STEP] (default: all)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Processes parsing an XDATCAR (default: number of CPUs)')
+    parser.add_argument('--float32', action='store_true',
+                        help='Store positions and velocities in single precision (half the memory)')
+    parser.add_argument('--msd', help='Write the species-resolved MSD to this file and print diffusion coefficients')
+    parser.add_argument('--append', action='store_true', help='Append the frames to an existing H5MD output')
 
     args = parser.parse_args()
-    main(args.input, args.output, args.timestep)
+    main(args.input, args.output, args.timestep, args.frames, args.workers,
+         np.float32 if args.float32 else np.float64, args.msd, args.append)